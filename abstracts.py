@@ -0,0 +1,122 @@
+import re
+
+# Tags whose only effect on the text is to split it. Anything else, such as
+# comments, scripts or unusual markup, goes to BeautifulSoup.
+SIMPLE_TAGS = {
+    "b",
+    "br",
+    "div",
+    "em",
+    "i",
+    "li",
+    "ol",
+    "p",
+    "span",
+    "strong",
+    "sub",
+    "sup",
+    "u",
+    "ul",
+}
+
+# html.parser ignores the end tags of void elements, so "a</br> b" is one
+# string. Those go to BeautifulSoup too.
+VOID_TAGS = {"br"}
+
+SIMPLE_TAG = re.compile(
+    r"<(/?)([a-zA-Z][a-zA-Z0-9]*)"
+    r"((?:\s+[a-zA-Z_:][-a-zA-Z0-9_:.]*"
+    r"(?:\s*=\s*(?:\"[^\"<>&]*\"|'[^'<>&]*'))?)*)"
+    r"\s*(/?)>"
+)
+
+ENTITY = re.compile(r"&(?:([a-zA-Z]+)|#([0-9]{1,7})|#[xX]([0-9a-fA-F]{1,6}));")
+
+NAMED_ENTITIES = {
+    "amp": "&",
+    "lt": "<",
+    "gt": ">",
+    "quot": '"',
+    "nbsp": "\xa0",
+}
+
+MARKUP = re.compile(r"[<&]")
+
+SPACES = re.compile(r" {2,}")
+
+
+def _entity(match):
+    name, decimal, hexadecimal = match.groups()
+    if name is not None:
+        return NAMED_ENTITIES.get(name)
+    code = int(decimal) if decimal is not None else int(hexadecimal, 16)
+    # The html.parser tree builder reads some low references as
+    # windows-1252, so only leave the unambiguous ones to the fast path.
+    if 32 <= code < 127 or 160 <= code < 0xD800 or 0xE000 <= code < 0x110000:
+        return chr(code)
+    return None
+
+
+def _strings(html):
+    # Split the abstract into the strings BeautifulSoup would find between
+    # tags, with entities decoded. Returns None if the markup isn't simple
+    # enough to be sure of that.
+    strings = []
+    current = []
+    pos = 0
+    while True:
+        match = MARKUP.search(html, pos)
+        if match is None:
+            current.append(html[pos:])
+            strings.append("".join(current))
+            return strings
+        start = match.start()
+        current.append(html[pos:start])
+        if html[start] == "<":
+            tag = SIMPLE_TAG.match(html, start)
+            if tag is None:
+                return None
+            name = tag.group(2).lower()
+            if name not in SIMPLE_TAGS or (tag.group(1) and name in VOID_TAGS):
+                return None
+            strings.append("".join(current))
+            current = []
+            pos = tag.end()
+        else:
+            entity = ENTITY.match(html, start)
+            character = None if entity is None else _entity(entity)
+            if character is None:
+                return None
+            current.append(character)
+            pos = entity.end()
+
+
+def get_text(html):
+    # The same text as BeautifulSoup(html, "html.parser").get_text(
+    # strip=True), without building a tree for simple abstracts.
+    strings = _strings(html)
+    if strings is None:
+        # bs4 takes a while to import, and most abstracts never need it.
+        from bs4 import BeautifulSoup
+
+        return BeautifulSoup(html, "html.parser").get_text(strip=True)
+    return "".join(s.strip() for s in strings)
+
+
+def normalize_abstract(html):
+    abstract = get_text(html)
+    abstract = abstract.replace("\r", "")
+    abstract = abstract.replace("\n", " ")
+    return SPACES.sub(" ", abstract)
+
+
+def normalize_abstracts(abstracts):
+    # For abstracts loaded in bulk. Repeated abstracts are only normalized
+    # once.
+    normalized = {}
+    results = []
+    for html in abstracts:
+        if html not in normalized:
+            normalized[html] = normalize_abstract(html)
+        results.append(normalized[html])
+    return results
@@ -0,0 +1,44 @@
+from staging import hash_file, link_file
+import datetime
+import os
+import shutil
+
+BAGIT_TXT = "BagIt-Version: 1.0\nTag-File-Character-Encoding: UTF-8\n"
+
+
+def bag_path_name(name):
+    # Manifests are line based, so line breaks and % are percent-encoded.
+    return name.replace("%", "%25").replace("\r", "%0D").replace("\n", "%0A")
+
+
+def write_bag(files, bag_path, tag_files):
+    # Write a BagIt bag of the staged files, which are (path, name, md5)
+    # with name relative to the payload. The MD5s were verified when the
+    # files were staged, so the payload is linked in and never read. The
+    # tag files, such as the import CSV, are small enough to hash. Returns
+    # the number of payload files.
+    if bag_path.exists():
+        shutil.rmtree(bag_path)
+    os.makedirs(bag_path / "data")
+    octets = 0
+    count = 0
+    with open(bag_path / "manifest-md5.txt", "w", encoding="utf-8") as f:
+        for path, name, md5 in files:
+            link_file(path, bag_path / "data" / name)
+            f.write(f"{md5.lower()}  data/{bag_path_name(name)}\n")
+            octets += os.path.getsize(path)
+            count += 1
+    with open(bag_path / "bagit.txt", "w", encoding="utf-8") as f:
+        f.write(BAGIT_TXT)
+    with open(bag_path / "bag-info.txt", "w", encoding="utf-8") as f:
+        f.write(f"Bagging-Date: {datetime.date.today().isoformat()}\n")
+        f.write(f"Payload-Oxum: {octets}.{count}\n")
+    tag_names = ["bagit.txt", "bag-info.txt", "manifest-md5.txt"]
+    for tag_file in tag_files:
+        shutil.copyfile(tag_file, bag_path / tag_file.name)
+        tag_names.append(tag_file.name)
+    with open(bag_path / "tagmanifest-md5.txt", "w", encoding="utf-8") as f:
+        for tag_name in tag_names:
+            md5 = hash_file(bag_path / tag_name)
+            f.write(f"{md5}  {bag_path_name(tag_name)}\n")
+    return count
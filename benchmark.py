@@ -0,0 +1,628 @@
+#! /usr/bin/env python
+
+import extract
+from instrumentation import Instrumentation
+from snapshot import INDEXED_COLUMNS
+from subject_index import build_index, load_subjects_header, sorted_unique
+import click
+import hashlib
+import itertools
+import json
+import os
+import pathlib
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import time
+
+# The columns each table needs for the extractor's queries. Field tables
+# also get entity_id and delta.
+FIELD_TABLES = {
+    "field_data_dcterms_creator": ["dcterms_creator_value"],
+    "field_data_dcterms_identifier": ["dcterms_identifier_url"],
+    "field_data_dcterms_subject": ["dcterms_subject_value"],
+    "field_data_dcterms_abstract": ["dcterms_abstract_value"],
+    "field_data_dcterms_publisher": ["dcterms_publisher_value"],
+    "field_data_dcterms_contributor": [
+        "dcterms_contributor_first",
+        "dcterms_contributor_second",
+    ],
+    "field_data_dcterms_date": ["dcterms_date_value"],
+    "field_data_dcterms_language": ["dcterms_language_first"],
+    "field_data_dcterms_description_noteinternal": [
+        "dcterms_description_noteinternal_value"
+    ],
+    "field_data_thesis_degree_name": [
+        "thesis_degree_name_first",
+        "thesis_degree_name_second",
+    ],
+    "field_data_thesis_degree_discipline": ["thesis_degree_discipline_value"],
+    "field_data_thesis_degree_level": ["thesis_degree_level_value"],
+    "field_data_etd_pdf": ["etd_pdf_fid"],
+    "field_data_etd_supplemental_files": ["etd_supplemental_files_fid"],
+    "field_data_signature_resource": ["signature_resource_target_id"],
+    "field_data_signature_policy_agreement": [
+        "signature_policy_agreement_target_id"
+    ],
+}
+
+OTHER_TABLES = {
+    "node": ["nid", "uuid", "title", "status", "type", "changed"],
+    "file_managed": ["fid", "uri", "filesize", "filename"],
+    "filehash": ["fid", "md5"],
+}
+
+LANGUAGES = ["English", "English", "English", "French", "Spanish", "German"]
+
+DEGREES = [
+    ("Master of Science", "M.Sc.", "Master's"),
+    ("Master of Arts", "M.A.", "Master's"),
+    ("Doctor of Philosophy", "Ph.D.", "Doctoral"),
+]
+
+WORDS = (
+    "analysis model river policy urban protein network canadian arctic "
+    "learning theory history migration energy signal structure culture"
+).split()
+
+# Generating random bytes for every file is slow, so each file is a
+# rotation of one random block.
+BLOCK_SIZE = 1 << 20
+
+PHASES = {
+    "full": [],
+    "incremental": ["--incremental"],
+    "subjects-only": ["--subjects-only"],
+}
+
+# Quick invocations whose start up is timed, and the modules that only the
+# code paths needing them should load.
+STARTUP_COMMANDS = {
+    "help": ["--help"],
+    "extract --help": ["extract", "--help"],
+}
+
+DEFERRED_MODULES = (
+    "bs4",
+    "pymysql",
+    "internal_notes",
+    "subject_index",
+    "concurrent.futures",
+    "multiprocessing",
+    "sqlite3",
+    "tarfile",
+    "zipfile",
+    "cProfile",
+)
+
+
+def lc_labels(rng, count):
+    # Synthetic LC headings, some with subdivisions.
+    labels = []
+    for i in range(count):
+        label = f"{rng.choice(WORDS).capitalize()} {i}"
+        if i % 3 == 0:
+            label += f"--{rng.choice(WORDS).capitalize()}"
+        labels.append(label)
+    return labels
+
+
+def subject_mix(rng, proquest_names, labels):
+    # ProQuest names, exact LC, LC that needs tidying, and no match at all.
+    kind = rng.random()
+    if kind < 0.3:
+        name = rng.choice(proquest_names)
+        return name.title() if rng.random() < 0.5 else name
+    label = rng.choice(labels)
+    if kind < 0.6:
+        return label
+    if kind < 0.9:
+        if "--" in label:
+            return label.replace("--", " -- ") + "."
+        return label + "."
+    return f"Unmapped {rng.choice(WORDS)} {rng.randrange(1000)}"
+
+
+def abstract(rng):
+    paragraphs = []
+    for _ in range(rng.randint(1, 4)):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(40, 120))]
+        words[rng.randrange(len(words))] = "<em>emphasis</em>"
+        words[rng.randrange(len(words))] = "R&amp;D"
+        paragraphs.append("<p>" + " ".join(words) + "</p>")
+    return "\r\n".join(paragraphs)
+
+
+def write_internal_notes(workdir, etds):
+    # internal_notes is private to the library and not in the repository,
+    # so the phases import this stand-in from the workdir instead.
+    notes = {nid: [f"Internal note {nid}"] for nid in range(1, etds + 1, 20)}
+    with open(workdir / "internal_notes.py", "w", encoding="utf-8") as f:
+        f.write(f"internal_notes = {notes!r}\n")
+
+
+def make_fixture(
+    workdir, etds, pdf_size, supplemental_size, supplemental_ratio, seed
+):
+    rng = random.Random(seed)
+    workdir.mkdir(parents=True, exist_ok=True)
+    files_path = workdir / "drupal-root/sites/default/files/private"
+    files_path.mkdir(parents=True, exist_ok=True)
+    block = rng.getrandbits(BLOCK_SIZE * 8).to_bytes(BLOCK_SIZE, "little")
+
+    repository_path = pathlib.Path(__file__).resolve().parent
+    proquest_to_lc, local_lc = load_subjects_header(
+        repository_path / "subjects_header.txt",
+        repository_path / "subjects_footer.txt",
+    )
+    labels = lc_labels(rng, max(100, etds))
+    build_index(
+        workdir / "subjects.idx",
+        sorted_unique(
+            itertools.chain(labels, local_lc, *proquest_to_lc.values())
+        ),
+        proquest_to_lc,
+    )
+    proquest_names = sorted(proquest_to_lc)
+
+    snapshot_path = workdir / "curve.sqlite"
+    if snapshot_path.exists():
+        os.remove(snapshot_path)
+    db = sqlite3.connect(str(snapshot_path))
+    tables = {
+        table: ["entity_id", "delta"] + columns
+        for table, columns in FIELD_TABLES.items()
+    }
+    tables.update(OTHER_TABLES)
+    for table, columns in tables.items():
+        db.execute(f'CREATE TABLE "{table}" ({", ".join(columns)})')
+
+    def insert(table, *values):
+        placeholders = ", ".join("?" * len(values))
+        db.execute(f'INSERT INTO "{table}" VALUES ({placeholders})', values)
+
+    def add_file(nid, table, size):
+        fid = next(fids)
+        name = f"etd-{nid}-{fid}.{'pdf' if table.endswith('pdf') else 'zip'}"
+        size = max(1, int(size * rng.uniform(0.5, 1.5)))
+        with open(files_path / name, "wb") as f:
+            hash_md5 = hashlib.md5()
+            start = fid * 4099 % BLOCK_SIZE
+            header = f"%ETD {nid} {fid}\n".encode("utf-8")
+            remaining = size
+            for chunk in itertools.chain(
+                [header], itertools.repeat(block[start:] + block[:start])
+            ):
+                chunk = chunk[:remaining]
+                f.write(chunk)
+                hash_md5.update(chunk)
+                remaining -= len(chunk)
+                if not remaining:
+                    break
+        insert(table, nid, 0, fid)
+        insert("file_managed", fid, f"private://{name}", size, name)
+        insert("filehash", fid, hash_md5.hexdigest())
+
+    fids = itertools.count(1)
+    for nid in range(1, etds + 1):
+        title = " ".join(rng.choice(WORDS) for _ in range(6)).capitalize()
+        insert(
+            "node", nid, f"uuid-{nid}", title, rng.randint(0, 1), "etd", nid
+        )
+        insert("field_data_dcterms_creator", nid, 0, f"Author, {nid}")
+        if rng.random() < 0.8:
+            insert(
+                "field_data_dcterms_identifier",
+                nid,
+                0,
+                f"https://doi.org/10.22215/etd/{nid}",
+            )
+        for delta in range(rng.randint(0, 4)):
+            insert(
+                "field_data_dcterms_subject",
+                nid,
+                delta,
+                subject_mix(rng, proquest_names, labels),
+            )
+        insert("field_data_dcterms_abstract", nid, 0, abstract(rng))
+        insert("field_data_dcterms_publisher", nid, 0, "Carleton University")
+        insert(
+            "field_data_dcterms_contributor",
+            nid,
+            0,
+            "Supervisor",
+            f"Supervisor {nid % 97}",
+        )
+        year = 1990 + nid % 35
+        insert("field_data_dcterms_date", nid, 0, f"{year}-05-01T00:00:00")
+        insert("field_data_dcterms_language", nid, 0, rng.choice(LANGUAGES))
+        if rng.random() < 0.1:
+            insert(
+                "field_data_dcterms_description_noteinternal",
+                nid,
+                0,
+                f"Note {nid}",
+            )
+        name, abbr, level = rng.choice(DEGREES)
+        insert("field_data_thesis_degree_name", nid, 0, name, abbr)
+        insert(
+            "field_data_thesis_degree_discipline",
+            nid,
+            0,
+            rng.choice(WORDS).capitalize(),
+        )
+        insert("field_data_thesis_degree_level", nid, 0, level)
+        if rng.random() < 0.95:
+            add_file(nid, "field_data_etd_pdf", pdf_size)
+            if rng.random() < supplemental_ratio:
+                add_file(
+                    nid, "field_data_etd_supplemental_files", supplemental_size
+                )
+        insert("field_data_signature_resource", etds + nid, 0, nid)
+        insert(
+            "field_data_signature_policy_agreement",
+            etds + nid,
+            0,
+            rng.randint(11, 17),
+        )
+    for table, columns in tables.items():
+        for column in INDEXED_COLUMNS:
+            if column in columns:
+                db.execute(
+                    f'CREATE INDEX "{table}_{column}" '
+                    f'ON "{table}" ("{column}")'
+                )
+    db.commit()
+    write_internal_notes(workdir, etds)
+    total_bytes = db.execute("SELECT SUM(filesize) FROM file_managed")
+    total_bytes = total_bytes.fetchone()[0] or 0
+    db.close()
+    return total_bytes
+
+
+def staged_files(destination_path):
+    # Files are identified by inode and modification time, so reused files
+    # don't count as staged.
+    files = {}
+    if destination_path.exists():
+        for path in destination_path.rglob("*"):
+            if path.is_file():
+                stat = path.stat()
+                name = path.relative_to(destination_path).as_posix()
+                files[name] = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    return files
+
+
+class CountingCursor:
+    """Counts the queries run through a cursor"""
+
+    def __init__(self, cursor, counter):
+        self.cursor = cursor
+        self.counter = counter
+
+    def execute(self, *args):
+        next(self.counter)
+        return self.cursor.execute(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cursor.close()
+
+
+class CountingConnection:
+    """Hands out counting cursors"""
+
+    def __init__(self, dbc, counter):
+        self.dbc = dbc
+        self.counter = counter
+
+    def cursor(self, *args):
+        return CountingCursor(self.dbc.cursor(*args), self.counter)
+
+    def close(self):
+        self.dbc.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def run_phase(args):
+    # Runs in a child process, so its peak RSS belongs to this phase alone.
+    counter = itertools.count()
+    connect = extract.connect
+    extract.connect = lambda params: CountingConnection(
+        connect(params), counter
+    )
+    params = extract.extract.make_context("extract", list(args)).params
+    destination_path = pathlib.Path(params["destination"]).resolve()
+    before = staged_files(destination_path)
+    etds = 0
+
+    def progress(n, file_bytes=0):
+        nonlocal etds
+        etds += n
+
+    start = time.perf_counter()
+    instrumentation = Instrumentation(
+        params["instrumentation_report"] is not None
+    )
+    if params["subjects_only"]:
+        extract.audit_subjects(params, progress, instrumentation)
+    elif params["shards"] > 1:
+        extract.extract_sharded(params, progress, instrumentation)
+    else:
+        extract.run_extraction(params, progress, instrumentation)
+    seconds = time.perf_counter() - start
+    queries = next(counter)
+    if instrumentation.enabled:
+        instrumentation.write_report(params["instrumentation_report"])
+    after = staged_files(destination_path)
+    staged_bytes = sum(
+        stat[2] for name, stat in after.items() if before.get(name) != stat
+    )
+    return {
+        "etds": etds,
+        "seconds": seconds,
+        "etds_per_second": etds / seconds,
+        # Sharded queries run in other processes and aren't counted.
+        "queries": queries,
+        "queries_per_etd": queries / max(etds, 1),
+        "staged_bytes": staged_bytes,
+        "staged_bytes_per_second": staged_bytes / seconds,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--etds", help="How many ETDs to generate", default=1000)
+@click.option("--pdf-size", help="Average PDF size in bytes", default=1 << 20)
+@click.option(
+    "--supplemental-size",
+    help="Average supplemental file size in bytes",
+    default=1 << 18,
+)
+@click.option(
+    "--supplemental-ratio",
+    help="The share of ETDs with a supplemental file",
+    default=0.2,
+)
+@click.option("--seed", help="Seed for the synthetic fixture", default=0)
+@click.option(
+    "--workdir",
+    help="Where to put the fixture and the extracted output",
+    default="benchmark",
+)
+@click.option(
+    "--phase",
+    "phases",
+    help="Which phases to run, in order",
+    type=click.Choice(list(PHASES)),
+    multiple=True,
+    default=list(PHASES),
+)
+@click.option(
+    "--keep-caches",
+    help="Start the full phase with the hash and subject caches of the "
+    "last run",
+    is_flag=True,
+)
+@click.option("--report", help="Also write the results to this JSON file")
+@click.argument("extract_args", nargs=-1, type=click.UNPROCESSED)
+def run(
+    etds,
+    pdf_size,
+    supplemental_size,
+    supplemental_ratio,
+    seed,
+    workdir,
+    phases,
+    keep_caches,
+    report,
+    extract_args,
+):
+    """Benchmark the extractor on a synthetic fixture
+
+    Arguments after -- are passed on to extract, for comparing modes such as
+    --db-connections or --copy-mode.
+    """
+    workdir = pathlib.Path(workdir).resolve()
+    settings = {
+        "etds": etds,
+        "pdf_size": pdf_size,
+        "supplemental_size": supplemental_size,
+        "supplemental_ratio": supplemental_ratio,
+        "seed": seed,
+    }
+    settings_path = workdir / "fixture.json"
+    try:
+        current = json.loads(settings_path.read_text())
+    except (FileNotFoundError, ValueError):
+        current = None
+    if current != settings or not (workdir / "internal_notes.py").exists():
+        start = time.perf_counter()
+        fixture_bytes = make_fixture(workdir, **settings)
+        settings_path.write_text(json.dumps(settings))
+        print(
+            f"Generated {etds} ETDs and {fixture_bytes} bytes of files in "
+            f"{time.perf_counter() - start:.1f}s"
+        )
+
+    output_path = workdir / "output"
+    output_path.mkdir(exist_ok=True)
+    hash_cache_path = output_path / "hash-cache.sqlite"
+    subject_cache_path = output_path / "subject-cache.json"
+    base_args = [
+        "--snapshot",
+        str(workdir / "curve.sqlite"),
+        "--subject-index",
+        str(workdir / "subjects.idx"),
+        "--drupal-root",
+        str(workdir / "drupal-root"),
+        "--destination",
+        str(output_path / "files"),
+        "--manifest",
+        str(output_path / "extract-manifest.json"),
+        "--journal",
+        str(output_path / "extract-journal.jsonl"),
+        "--hyrax-import",
+        str(output_path / "hyrax_import.csv"),
+        "--subject-log",
+        str(output_path / "subject-processing-log.csv"),
+        "--subject-report",
+        str(output_path / "subject-report.csv"),
+        "--error-report",
+        str(output_path / "extract-errors.csv"),
+        "--hash-cache",
+        str(hash_cache_path),
+        "--subject-cache",
+        str(subject_cache_path),
+    ]
+    # The phases import the fixture's internal_notes.
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [str(workdir), os.environ.get("PYTHONPATH")])
+    )
+    results = {}
+    print(
+        f"{'phase':<14}{'ETDs':>8}{'s':>9}{'ETDs/s':>10}{'q/ETD':>8}"
+        f"{'MB/s':>9}{'peak MB':>9}"
+    )
+    for phase in phases:
+        if phase == "full" and not keep_caches:
+            # Otherwise the full phase measures what earlier runs cached.
+            for path in (
+                hash_cache_path,
+                hash_cache_path.with_name(hash_cache_path.name + "-wal"),
+                hash_cache_path.with_name(hash_cache_path.name + "-shm"),
+                subject_cache_path,
+            ):
+                if path.exists():
+                    path.unlink()
+        args = base_args + PHASES[phase] + list(extract_args)
+        output = subprocess.run(
+            [sys.executable, __file__, "phase", "--", *args],
+            stdout=subprocess.PIPE,
+            env=env,
+            check=True,
+        ).stdout
+        result = json.loads(output)
+        results[phase] = result
+        print(
+            f"{phase:<14}{result['etds']:>8}{result['seconds']:>9.2f}"
+            f"{result['etds_per_second']:>10.1f}"
+            f"{result['queries_per_etd']:>8.2f}"
+            f"{result['staged_bytes_per_second'] / 1e6:>9.1f}"
+            f"{result['peak_rss_kb'] / 1024:>9.1f}"
+        )
+    if report:
+        with open(report, "w") as f:
+            json.dump(
+                {"fixture": settings, "args": extract_args, "phases": results},
+                f,
+                indent=2,
+            )
+
+
+def median_milliseconds(args, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(args, stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2] * 1000
+
+
+@cli.command()
+@click.option(
+    "--runs",
+    help="How many times to start each command",
+    default=10,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--budget",
+    help="The most milliseconds a command may add to starting Python",
+    default=150.0,
+)
+@click.option("--report", help="Also write the results to this JSON file")
+@click.pass_context
+def startup(ctx, runs, budget, report):
+    """Check that quick invocations of extract start within a budget
+
+    Each command is timed in fresh processes, less the time Python itself
+    takes to start. Importing extract must not load any of the deferred
+    modules.
+    """
+    extract_path = pathlib.Path(extract.__file__).resolve()
+    python = median_milliseconds([sys.executable, "-c", "pass"], runs)
+    results = {}
+    print(f"{'command':<16}{'ms':>8}")
+    for name, args in STARTUP_COMMANDS.items():
+        milliseconds = (
+            median_milliseconds([sys.executable, extract_path, *args], runs)
+            - python
+        )
+        results[name] = milliseconds
+        print(f"{name:<16}{milliseconds:>8.1f}")
+    loaded = json.loads(
+        subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import extract, json, sys; "
+                f"print(json.dumps([m for m in {DEFERRED_MODULES!r} "
+                "if m in sys.modules]))",
+            ],
+            cwd=extract_path.parent,
+            stdout=subprocess.PIPE,
+            check=True,
+        ).stdout
+    )
+    if loaded:
+        print("Loaded at start up: ", ", ".join(loaded))
+    if report:
+        with open(report, "w") as f:
+            json.dump(
+                {
+                    "python_ms": python,
+                    "budget_ms": budget,
+                    "commands_ms": results,
+                    "loaded": loaded,
+                },
+                f,
+                indent=2,
+            )
+    over = [name for name, ms in results.items() if ms > budget]
+    if over:
+        print(f"Over the {budget:g} ms budget: ", ", ".join(over))
+    if over or loaded:
+        ctx.exit(1)
+
+
+@cli.command(hidden=True)
+@click.argument("extract_args", nargs=-1, type=click.UNPROCESSED)
+def phase(extract_args):
+    print(json.dumps(run_phase(extract_args)))
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,48 @@
+from concurrent.futures import ThreadPoolExecutor
+from instrumentation import Instrumentation
+from throttle import Throttle
+import queue
+import time
+
+
+class ConnectionPool:
+    """Runs queries concurrently, each on a connection of its own"""
+
+    def __init__(self, connect, size, instrumentation=None, throttle=None):
+        self.connections = queue.Queue()
+        for _ in range(size):
+            self.connections.put(connect())
+        self.size = size
+        self.executor = ThreadPoolExecutor(max_workers=size)
+        self.instrumentation = instrumentation or Instrumentation(False)
+        self.throttle = throttle or Throttle()
+
+    def _fetchall(self, sql, params, stage):
+        self.throttle.query()
+        dbc = self.connections.get()
+        try:
+            start = time.perf_counter()
+            with dbc.cursor() as cursor:
+                cursor.execute(sql, params)
+                rows = cursor.fetchall()
+            self.instrumentation.record(
+                stage, time.perf_counter() - start, queries=1, rows=len(rows)
+            )
+            return rows
+        finally:
+            self.connections.put(dbc)
+
+    def submit(self, sql, params, stage="query"):
+        # Returns a future for the rows.
+        return self.executor.submit(self._fetchall, sql, params, stage)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for _ in range(self.size):
+            self.connections.get().close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,2 @@
+class ProcessingException(Exception):
+    """Raised when the processor encounters bad ETD data"""
@@ -1,16 +1,39 @@
 #! /usr/bin/env python
 
-from bs4 import BeautifulSoup
-from internal_notes import internal_notes
+from abstracts import normalize_abstracts
+from exceptions import ProcessingException
+from instrumentation import Instrumentation
 import click
+import contextlib
 import csv
-import hashlib
+import datetime
+import functools
+import heapq
+import itertools
 import os
 import pathlib
-import pymysql
-import re
+import queue
 import shutil
-import subjects as s
+import signal
+import time
+from manifest import Journal, Manifest, read_entries
+from package import PACKAGE_FORMATS
+from record import Record
+from staging import (
+    COPY_MODES,
+    DRUPAL_ROOT,
+    LAYOUTS,
+    Stager,
+    deduplicated_name,
+    layout_name,
+    source_path,
+    source_size,
+)
+from throttle import Throttle
+
+# Modules that only some commands need, such as pymysql, BeautifulSoup and
+# the subject index, are imported by the functions that use them, so quick
+# invocations start quickly.
 
 SPLIT_PATTERN = "|||"
 
@@ -21,43 +44,137 @@ ACCESS_NOTE = (
 )
 
 
-class ProcessingException(Exception):
-    """Raised when the processor encounters bad ETD data"""
+ETD_CONDITIONS = (
+    "FROM `node` "
+    "WHERE `node`.`type` = 'etd' "
+    "AND `node`.`uuid` NOT IN ( "
+    "  '50892e3d-aa3e-4722-b2a0-012accb0c52a' "  # Duplicate of a4c09901-eb02-4746-995d-343fb23111cd # noqa: E501
+    ")"
+)
 
 
-def get_etds(dbc):
+def count_etds(dbc):
     with dbc.cursor() as cursor:
-        sql = (
-            "SELECT "
-            "`nid` AS 'nid', "
-            "`node`.`uuid` AS 'source_identifier', "
-            "`node`.`title` AS 'title', "
-            "CASE `node`.`status` "
-            "  WHEN 0 THEN 'restricted' "
-            "  WHEN 1 THEN 'open' "
-            "END "
-            "AS 'visibility' "
-            "FROM `node` "
-            "WHERE `node`.`type` = 'etd' "
-            "AND `node`.`uuid` NOT IN ( "
-            "  '50892e3d-aa3e-4722-b2a0-012accb0c52a' "  # Duplicate of a4c09901-eb02-4746-995d-343fb23111cd # noqa: E501
-            ")"
-        )
-        cursor.execute(sql)
-        rows = cursor.fetchall()
-    return rows
+        cursor.execute("SELECT COUNT(*) AS 'count' " + ETD_CONDITIONS)
+        return cursor.fetchone()["count"]
 
 
-def add_creator(dbc, etd):
+def count_file_bytes(dbc):
+    total = 0
     with dbc.cursor() as cursor:
-        sql = (
-            "SELECT "
-            "`dcterms_creator_value` as 'creator' "
-            "FROM `field_data_dcterms_creator` "
-            "WHERE `entity_id` = %s"
-        )
-        cursor.execute(sql, (etd["nid"],))
-        rows = cursor.fetchall()
+        for table, column in (
+            ("field_data_etd_pdf", "etd_pdf_fid"),
+            (
+                "field_data_etd_supplemental_files",
+                "etd_supplemental_files_fid",
+            ),
+        ):
+            cursor.execute(
+                "SELECT SUM(`file_managed`.`filesize`) AS 'bytes' "
+                f"FROM `{table}` "
+                "JOIN `file_managed` ON "
+                f"`{table}`.`{column}` = `file_managed`.`fid` "
+                f"WHERE `{table}`.`entity_id` IN (SELECT `node`.`nid` "
+                + ETD_CONDITIONS
+                + ")"
+            )
+            total += int(cursor.fetchone()["bytes"] or 0)
+    return total
+
+
+def file_bytes(file_rows):
+    return sum(int(row["filesize"] or 0) for row in file_rows)
+
+
+def get_etds(dbc, page_size, shard=None):
+    # The node rows are read a page at a time, keyed on nid, so no result
+    # set stays open on the server while the ETDs are processed.
+    sql = (
+        "SELECT "
+        "`nid` AS 'nid', "
+        "`node`.`uuid` AS 'source_identifier', "
+        "`node`.`title` AS 'title', "
+        "`node`.`changed` AS 'changed', "
+        "CASE `node`.`status` "
+        "  WHEN 0 THEN 'restricted' "
+        "  WHEN 1 THEN 'open' "
+        "END "
+        "AS 'visibility' " + ETD_CONDITIONS + " AND `node`.`nid` > %s"
+    )
+    shard_params = ()
+    if shard is not None:
+        # Shard by nid modulo the number of shards.
+        sql += " AND `node`.`nid` %% %s = %s"
+        shard_params = (shard[1], shard[0])
+    # A stable order lets sharded runs merge back into the serial order.
+    sql += " ORDER BY `node`.`nid` LIMIT %s"
+    last_nid = 0
+    while True:
+        with dbc.cursor() as cursor:
+            cursor.execute(sql, (last_nid, *shard_params, page_size))
+            rows = cursor.fetchall()
+        for row in rows:
+            yield Record(row)
+        if len(rows) < page_size:
+            return
+        last_nid = rows[-1]["nid"]
+
+
+def batched(etds, batch_size):
+    etds = iter(etds)
+    while True:
+        batch = list(itertools.islice(etds, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def submit_fields(pool, etds, fields):
+    # Run each field query once for the whole batch. The queries don't
+    # depend on each other, so they all go to the pool at once.
+    nids = tuple(etd["nid"] for etd in etds)
+    return nids, {
+        field: pool.submit(FIELD_SQL[field], (nids,), f"query {field}")
+        for field in fields
+    }
+
+
+def gather_fields(submitted):
+    # Group the rows by nid, so the add_* functions see the same rows they
+    # would have fetched for a single ETD.
+    nids, futures = submitted
+    loaded = {}
+    for field, future in futures.items():
+        grouped = {nid: [] for nid in nids}
+        for row in future.result():
+            grouped[row["nid"]].append(row)
+        loaded[field] = grouped
+    return loaded
+
+
+def prefetched(batches, submit):
+    # Yield each batch with its submitted queries, submitting the next
+    # batch's queries before the current one is handed over.
+    previous = None
+    for batch in batches:
+        current = (batch, submit(batch))
+        if previous is not None:
+            yield previous
+        previous = current
+    if previous is not None:
+        yield previous
+
+
+CREATOR_SQL = (
+    "SELECT "
+    "`entity_id` AS 'nid', "
+    "`dcterms_creator_value` as 'creator' "
+    "FROM `field_data_dcterms_creator` "
+    "WHERE `entity_id` IN %s"
+)
+
+
+def add_creator(etd, rows):
     if len(rows) != 1:
         raise ProcessingException(
             f"ERROR - {etd} does not have exactly one creator."
@@ -65,16 +182,16 @@ def add_creator(dbc, etd):
     etd["creator"] = rows[0]["creator"].strip()
 
 
-def add_identifier(dbc, etd):
-    with dbc.cursor() as cursor:
-        sql = (
-            "SELECT "
-            "`dcterms_identifier_url` as 'identifier'"
-            "FROM `field_data_dcterms_identifier` "
-            "WHERE `entity_id` = %s"
-        )
-        cursor.execute(sql, (etd["nid"],))
-        rows = cursor.fetchall()
+IDENTIFIER_SQL = (
+    "SELECT "
+    "`entity_id` AS 'nid', "
+    "`dcterms_identifier_url` as 'identifier' "
+    "FROM `field_data_dcterms_identifier` "
+    "WHERE `entity_id` IN %s"
+)
+
+
+def add_identifier(etd, rows):
     if not rows:
         etd["identifier"] = ""
     for row in rows:
@@ -86,135 +203,86 @@ def add_identifier(dbc, etd):
         etd["identifier"] = ""
 
 
-def add_subjects(dbc, etd, subject_processing_log_path):
-    with dbc.cursor() as cursor:
-        sql = (
-            "SELECT "
-            "`dcterms_subject_value` as 'subject' "
-            "FROM `field_data_dcterms_subject` "
-            "WHERE `entity_id` = %s "
-            "ORDER BY `delta`"
-        )
-        cursor.execute(sql, (etd["nid"],))
-        rows = cursor.fetchall()
+SUBJECTS_SQL = (
+    "SELECT "
+    "`entity_id` AS 'nid', "
+    "`dcterms_subject_value` as 'subject' "
+    "FROM `field_data_dcterms_subject` "
+    "WHERE `entity_id` IN %s "
+    "ORDER BY `entity_id`, `delta`"
+)
+
 
+def add_subjects(etd, rows, subject_log, subject_resolver):
     subjects = []
-    with open(
-        subject_processing_log_path, "a", newline="", encoding="utf-8"
-    ) as csv_file:
-        csv_writer = csv.writer(csv_file)
-        if not rows:
-            csv_writer.writerow(
+    if not rows:
+        subject_log.append(
+            [
+                etd["title"],
+                f"https://curve.carleton.ca/node/{etd['nid']}",
+                etd["identifier"],
+                etd["creator"],
+                "CURVE record has no subjects",
+                "",
+            ]
+        )
+    else:
+        for row in rows:
+            subject = row["subject"].strip()
+            headings, action = subject_resolver.resolve(subject)
+            subjects.extend(headings)
+            subject_log.append(
                 [
                     etd["title"],
                     f"https://curve.carleton.ca/node/{etd['nid']}",
                     etd["identifier"],
                     etd["creator"],
-                    "CURVE record has no subjects",
-                    "",
+                    action,
+                    subject,
                 ]
             )
-        else:
-            for row in rows:
-                subject = row["subject"].strip()
-                if subject.lower() in s.proquest_to_lc:
-                    lcs_from_proquest = s.proquest_to_lc[subject.lower()]
-                    subjects.extend(lcs_from_proquest)
-                    flat_lcs = "|".join(lcs_from_proquest)
-                    csv_writer.writerow(
-                        [
-                            etd["title"],
-                            f"https://curve.carleton.ca/node/{etd['nid']}",
-                            etd["identifier"],
-                            etd["creator"],
-                            f"Mapped from proquest to LC {flat_lcs}",
-                            subject,
-                        ]
-                    )
-                elif subject in s.lc:
-                    subjects.append(subject)
-                    csv_writer.writerow(
-                        [
-                            etd["title"],
-                            f"https://curve.carleton.ca/node/{etd['nid']}",
-                            etd["identifier"],
-                            etd["creator"],
-                            "Exact LC match found",
-                            subject,
-                        ]
-                    )
-                else:
-                    processed_subject = process_subject(subject)
-                    if processed_subject in s.lc:
-                        subjects.append(processed_subject)
-                        csv_writer.writerow(
-                            [
-                                etd["title"],
-                                f"https://curve.carleton.ca/node/{etd['nid']}",
-                                etd["identifier"],
-                                etd["creator"],
-                                f"LC match '{processed_subject}' found",
-                                subject,
-                            ]
-                        )
-                    else:
-                        subjects.append(subject)
-                        csv_writer.writerow(
-                            [
-                                etd["title"],
-                                f"https://curve.carleton.ca/node/{etd['nid']}",
-                                etd["identifier"],
-                                etd["creator"],
-                                "No LC match",
-                                subject,
-                            ]
-                        )
     etd["subjects"] = SPLIT_PATTERN.join(subjects)
 
 
-def process_subject(subject):
-    # Use LC standard, no spaces around double dash.
-    subject = subject.replace(" -- ", "--")
-    subject = subject.replace("-- ", "--")
-    subject = subject.replace(" --", "--")
-    # Drop trailing periods.
-    subject = subject.rstrip(".")
-    return subject
+ABSTRACT_SQL = (
+    "SELECT "
+    "`entity_id` AS 'nid', "
+    "`dcterms_abstract_value` as 'abstract' "
+    "FROM `field_data_dcterms_abstract` "
+    "WHERE `entity_id` IN %s"
+)
 
 
-def add_abstract(dbc, etd):
-    with dbc.cursor() as cursor:
-        sql = (
-            "SELECT "
-            "`dcterms_abstract_value` as 'abstract' "
-            "FROM `field_data_dcterms_abstract` "
-            "WHERE `entity_id` = %s"
-        )
-        cursor.execute(sql, (etd["nid"],))
-        rows = cursor.fetchall()
+def normalize_batch_abstracts(abstract_rows):
+    # Normalize the abstracts of a whole batch in place, before the ETDs are
+    # built, so each distinct abstract is only parsed once.
+    rows = [row for rows in abstract_rows.values() for row in rows]
+    for row, abstract in zip(
+        rows, normalize_abstracts(row["abstract"] for row in rows)
+    ):
+        row["abstract"] = abstract
+
+
+def add_abstract(etd, rows):
+    # The rows have been through normalize_batch_abstracts.
     if len(rows) > 1:
         raise ProcessingException(f"ERROR - {etd} has more than one abstract.")
     elif len(rows) == 1:
-        soup = BeautifulSoup(rows[0]["abstract"], "html.parser")
-        abstract = soup.get_text(strip=True)
-        abstract = abstract.replace("\r", "")
-        abstract = abstract.replace("\n", " ")
-        abstract = re.sub(r" {2,}", " ", abstract)
-        etd["abstract"] = abstract
+        etd["abstract"] = rows[0]["abstract"]
     else:
         etd["abstract"] = ""
 
 
-def add_publisher(dbc, etd):
-    with dbc.cursor() as cursor:
-        sql = (
-            "SELECT "
-            "`dcterms_publisher_value` as 'publisher' "
-            "FROM `field_data_dcterms_publisher` "
-            "WHERE `entity_id` = %s"
-        )
-        cursor.execute(sql, (etd["nid"],))
-        rows = cursor.fetchall()
+PUBLISHER_SQL = (
+    "SELECT "
+    "`entity_id` AS 'nid', "
+    "`dcterms_publisher_value` as 'publisher' "
+    "FROM `field_data_dcterms_publisher` "
+    "WHERE `entity_id` IN %s"
+)
+
+
+def add_publisher(etd, rows):
     if len(rows) != 1:
         raise ProcessingException(
             f"ERROR - {etd} does not have exactly one publisher."
@@ -222,17 +290,17 @@ def add_publisher(dbc, etd):
     etd["publisher"] = rows[0]["publisher"].strip()
 
 
-def add_contributors(dbc, etd):
-    with dbc.cursor() as cursor:
-        sql = (
-            "SELECT "
-            "`dcterms_contributor_first` as 'contributor_role', "
-            "`dcterms_contributor_second` as 'contributor_name' "
-            "FROM `field_data_dcterms_contributor` "
-            "WHERE `entity_id` = %s"
-        )
-        cursor.execute(sql, (etd["nid"],))
-        rows = cursor.fetchall()
+CONTRIBUTORS_SQL = (
+    "SELECT "
+    "`entity_id` AS 'nid', "
+    "`dcterms_contributor_first` as 'contributor_role', "
+    "`dcterms_contributor_second` as 'contributor_name' "
+    "FROM `field_data_dcterms_contributor` "
+    "WHERE `entity_id` IN %s"
+)
+
+
+def add_contributors(etd, rows):
     contributors = []
     for row in rows:
         name = row["contributor_name"].strip()
@@ -246,16 +314,16 @@ def add_contributors(dbc, etd):
     etd["contributors"] = SPLIT_PATTERN.join(contributors)
 
 
-def add_date(dbc, etd):
-    with dbc.cursor() as cursor:
-        sql = (
-            "SELECT "
-            "`dcterms_date_value` as 'date' "
-            "FROM `field_data_dcterms_date` "
-            "WHERE `entity_id` = %s"
-        )
-        cursor.execute(sql, (etd["nid"],))
-        rows = cursor.fetchall()
+DATE_SQL = (
+    "SELECT "
+    "`entity_id` AS 'nid', "
+    "`dcterms_date_value` as 'date' "
+    "FROM `field_data_dcterms_date` "
+    "WHERE `entity_id` IN %s"
+)
+
+
+def add_date(etd, rows):
     if len(rows) != 1:
         raise ProcessingException(
             f"ERROR - {etd} does not have exactly one date."
@@ -264,30 +332,20 @@ def add_date(dbc, etd):
 
 
 def add_rights_notes(etd):
-    etd["rights_notes"] = (
-        f"Copyright © {etd['date'][:4]} the author(s). Theses may be used for "
-        "non-commercial research, educational, or related academic purposes  "
-        "only. Such uses include personal study, research, scholarship, and "
-        "teaching. Theses may only be shared by linking to Carleton "
-        "University Institutional Repository and no part may be used without "
-        "proper attribution to the author. No part may be used for commercial" 
-        " purposes directly or indirectly via a for-profit platform; no "
-        "adaptation or derivative works are permitted without consent from "
-        "the copyright owner."
-    )
-    print(etd["rights_note"])
+    # The notes only differ by year, and are rendered from it when needed.
+    etd["rights_year"] = etd["date"][:4]
 
 
-def add_language(dbc, etd):
-    with dbc.cursor() as cursor:
-        sql = (
-            "SELECT "
-            "`dcterms_language_first` as 'language' "
-            "FROM `field_data_dcterms_language` "
-            "WHERE `entity_id` = %s"
-        )
-        cursor.execute(sql, (etd["nid"],))
-        rows = cursor.fetchall()
+LANGUAGE_SQL = (
+    "SELECT "
+    "`entity_id` AS 'nid', "
+    "`dcterms_language_first` as 'language' "
+    "FROM `field_data_dcterms_language` "
+    "WHERE `entity_id` IN %s"
+)
+
+
+def add_language(etd, rows):
     if len(rows) != 1:
         raise ProcessingException(
             f"ERROR - {etd} does not have exactly one language."
@@ -305,32 +363,41 @@ def add_language(dbc, etd):
         raise ProcessingException(f"ERROR - {etd} has unexpected language.")
 
 
-def add_internal_notes(dbc, etd):
-    with dbc.cursor() as cursor:
-        sql = (
-            "SELECT "
-            "`dcterms_description_noteinternal_value` as 'note' "
-            "FROM `field_data_dcterms_description_noteinternal` "
-            "WHERE `entity_id` = %s"
-        )
-        cursor.execute(sql, (etd["nid"],))
-        rows = cursor.fetchall()
+INTERNAL_NOTES_SQL = (
+    "SELECT "
+    "`entity_id` AS 'nid', "
+    "`dcterms_description_noteinternal_value` as 'note' "
+    "FROM `field_data_dcterms_description_noteinternal` "
+    "WHERE `entity_id` IN %s"
+)
+
+
+@functools.lru_cache(maxsize=None)
+def load_internal_notes():
+    # The notes module is large, so it is only imported by runs that add
+    # internal notes.
+    from internal_notes import internal_notes
+
+    return internal_notes
+
+
+def add_internal_notes(etd, rows):
     notes = [row["note"] for row in rows]
-    notes.extend(internal_notes.get(etd["nid"], []))
+    notes.extend(load_internal_notes().get(etd["nid"], []))
     etd["internal_notes"] = SPLIT_PATTERN.join(notes)
 
 
-def add_degree(dbc, etd):
-    with dbc.cursor() as cursor:
-        sql = (
-            "SELECT "
-            "`thesis_degree_name_first` as 'name', "
-            "`thesis_degree_name_second` as 'abbr' "
-            "FROM `field_data_thesis_degree_name` "
-            "WHERE `entity_id` = %s"
-        )
-        cursor.execute(sql, (etd["nid"],))
-        rows = cursor.fetchall()
+DEGREE_SQL = (
+    "SELECT "
+    "`entity_id` AS 'nid', "
+    "`thesis_degree_name_first` as 'name', "
+    "`thesis_degree_name_second` as 'abbr' "
+    "FROM `field_data_thesis_degree_name` "
+    "WHERE `entity_id` IN %s"
+)
+
+
+def add_degree(etd, rows):
     if len(rows) != 1:
         raise ProcessingException(
             f"ERROR - {etd} does not have exactly one degree."
@@ -338,16 +405,16 @@ def add_degree(dbc, etd):
     etd["degree"] = f"{rows[0]['name']} ({rows[0]['abbr']})"
 
 
-def add_degree_discipline(dbc, etd):
-    with dbc.cursor() as cursor:
-        sql = (
-            "SELECT "
-            "`thesis_degree_discipline_value` as 'discipline' "
-            "FROM `field_data_thesis_degree_discipline` "
-            "WHERE `entity_id` = %s"
-        )
-        cursor.execute(sql, (etd["nid"],))
-        rows = cursor.fetchall()
+DEGREE_DISCIPLINE_SQL = (
+    "SELECT "
+    "`entity_id` AS 'nid', "
+    "`thesis_degree_discipline_value` as 'discipline' "
+    "FROM `field_data_thesis_degree_discipline` "
+    "WHERE `entity_id` IN %s"
+)
+
+
+def add_degree_discipline(etd, rows):
     if len(rows) > 1:
         raise ProcessingException(
             f"ERROR - {etd} has more than one degree discipline."
@@ -358,16 +425,16 @@ def add_degree_discipline(dbc, etd):
         etd["degree_discipline"] = ""
 
 
-def add_degree_level(dbc, etd):
-    with dbc.cursor() as cursor:
-        sql = (
-            "SELECT "
-            "`thesis_degree_level_value` as 'level' "
-            "FROM `field_data_thesis_degree_level` "
-            "WHERE `entity_id` = %s"
-        )
-        cursor.execute(sql, (etd["nid"],))
-        rows = cursor.fetchall()
+DEGREE_LEVEL_SQL = (
+    "SELECT "
+    "`entity_id` AS 'nid', "
+    "`thesis_degree_level_value` as 'level' "
+    "FROM `field_data_thesis_degree_level` "
+    "WHERE `entity_id` IN %s"
+)
+
+
+def add_degree_level(etd, rows):
     if len(rows) != 1:
         raise ProcessingException(
             f"ERROR - {etd} does not have exactly one degree level."
@@ -383,108 +450,104 @@ def add_degree_level(dbc, etd):
         )
 
 
-def add_pdf_file_or_access_right(dbc, etd, destination_path):
-    with dbc.cursor() as cursor:
-        sql = (
-            "SELECT "
-            "`file_managed`.`uri` as 'uri', "
-            "`filehash`.`md5` as 'md5' "
-            "FROM `field_data_etd_pdf` "
-            "LEFT JOIN `file_managed` ON "
-            "`field_data_etd_pdf`.`etd_pdf_fid` = `file_managed`.`fid` "
-            "LEFT JOIN `filehash` ON "
-            "`field_data_etd_pdf`.`etd_pdf_fid` = `filehash`.`fid` "
-            "WHERE `field_data_etd_pdf`.`entity_id` = %s"
+PDF_SQL = (
+    "SELECT "
+    "`field_data_etd_pdf`.`entity_id` AS 'nid', "
+    "`field_data_etd_pdf`.`etd_pdf_fid` AS 'fid', "
+    "`file_managed`.`uri` as 'uri', "
+    "`file_managed`.`filesize` as 'filesize', "
+    "`filehash`.`md5` as 'md5' "
+    "FROM `field_data_etd_pdf` "
+    "LEFT JOIN `file_managed` ON "
+    "`field_data_etd_pdf`.`etd_pdf_fid` = `file_managed`.`fid` "
+    "LEFT JOIN `filehash` ON "
+    "`field_data_etd_pdf`.`etd_pdf_fid` = `filehash`.`fid` "
+    "WHERE `field_data_etd_pdf`.`entity_id` IN %s"
+)
+
+
+def check_file_row(row):
+    # The file tables are left joined, so a file missing from file_managed
+    # or filehash comes back with NULLs.
+    if row["uri"] is None:
+        raise ProcessingException(
+            f"ERROR - file {row['fid']} isn't in file_managed."
         )
-        cursor.execute(sql, (etd["nid"],))
-        rows = cursor.fetchall()
+    if row["md5"] is None:
+        raise ProcessingException(f"ERROR - {row['uri']} has no filehash.")
+
+
+def add_pdf_file_or_access_right(etd, rows, stager):
     if len(rows) > 1:
         raise ProcessingException(f"ERROR - {etd} has more than one pdf file.")
     elif len(rows) == 1:
-        etd["file"] = process_file_uri(
-            rows[0]["uri"], destination_path, rows[0]["md5"]
+        row = rows[0]
+        check_file_row(row)
+        name, requested = stager.stage(
+            row["uri"], row["md5"], etd["nid"], row["fid"]
         )
+        etd["file"] = name
         etd["access_right"] = ""
+        etd["staged_files"] = [[name, row["fid"], row["md5"], requested]]
     else:
         etd["file"] = ""
         etd["access_right"] = ACCESS_NOTE
+        etd["staged_files"] = []
 
 
-def add_supplemental_file(dbc, etd, destination_path):
-    with dbc.cursor() as cursor:
-        sql = (
-            "SELECT "
-            "`file_managed`.`uri` as 'uri', "
-            "`filehash`.`md5` as 'md5' "
-            "FROM `field_data_etd_supplemental_files` "
-            "LEFT JOIN `file_managed` ON "
-            "`field_data_etd_supplemental_files`.`etd_supplemental_files_fid`"
-            " = "
-            "`file_managed`.`fid` "
-            "LEFT JOIN `filehash` ON "
-            "`field_data_etd_supplemental_files`.`etd_supplemental_files_fid` "
-            " = "
-            "`filehash`.`fid` "
-            "WHERE `field_data_etd_supplemental_files`.`entity_id` = %s"
-        )
-        cursor.execute(sql, (etd["nid"],))
-        rows = cursor.fetchall()
+SUPPLEMENTAL_FILE_SQL = (
+    "SELECT "
+    "`field_data_etd_supplemental_files`.`entity_id` AS 'nid', "
+    "`field_data_etd_supplemental_files`.`etd_supplemental_files_fid` "
+    "AS 'fid', "
+    "`file_managed`.`uri` as 'uri', "
+    "`file_managed`.`filesize` as 'filesize', "
+    "`filehash`.`md5` as 'md5' "
+    "FROM `field_data_etd_supplemental_files` "
+    "LEFT JOIN `file_managed` ON "
+    "`field_data_etd_supplemental_files`.`etd_supplemental_files_fid`"
+    " = "
+    "`file_managed`.`fid` "
+    "LEFT JOIN `filehash` ON "
+    "`field_data_etd_supplemental_files`.`etd_supplemental_files_fid` "
+    " = "
+    "`filehash`.`fid` "
+    "WHERE `field_data_etd_supplemental_files`.`entity_id` IN %s"
+)
+
+
+def add_supplemental_file(etd, rows, stager):
     if len(rows) > 1:
         raise ProcessingException(
             f"ERROR - {etd} has more than one supplemental file."
         )
     elif len(rows) == 1:
-        etd["file"] = (
-            etd["file"]
-            + SPLIT_PATTERN
-            + process_file_uri(
-                rows[0]["uri"], destination_path, rows[0]["md5"]
-            )
+        row = rows[0]
+        check_file_row(row)
+        name, requested = stager.stage(
+            row["uri"], row["md5"], etd["nid"], row["fid"]
         )
+        etd["file"] = etd["file"] + SPLIT_PATTERN + name
+        etd["staged_files"].append([name, row["fid"], row["md5"], requested])
 
 
-def process_file_uri(uri, destination_path, md5):
-    file_source_path = pathlib.Path(
-        "/var/www/drupal/drupal-root/"
-        + uri.replace("private://", "sites/default/files/private/").replace(
-            "public://", "sites/default/files/"
-        )
-    )
-    if not file_source_path.exists():
-        raise ProcessingException(f"ERROR - {uri} doesn't exist.")
-    file_destination_path = destination_path / file_source_path.name
-    if file_destination_path.exists():
-        raise ProcessingException(
-            f"ERROR - {file_destination_path} already copied."
-        )
-    shutil.copy(file_source_path, file_destination_path)
-    hash_md5 = hashlib.md5()
-    with open(file_destination_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    if hash_md5.hexdigest().lower() != md5.lower():
-        raise ProcessingException(
-            f"ERROR - {file_destination_path} has the wrong hash."
-        )
-    return str(file_destination_path.name)
+AGREEMENT_SQL = (
+    "SELECT "
+    "`field_data_signature_resource`.`signature_resource_target_id` "
+    "AS 'nid', "
+    "`signature_policy_agreement_target_id` as 'agreement' "
+    "FROM `field_data_signature_resource` "
+    "LEFT JOIN `field_data_signature_policy_agreement` ON "
+    "`field_data_signature_policy_agreement`.`entity_id`"
+    " = "
+    "`field_data_signature_resource`.`entity_id` "
+    "WHERE "
+    "`field_data_signature_resource`.`signature_resource_target_id` "
+    "IN %s"
+)
 
 
-def add_agreement(dbc, etd):
-    with dbc.cursor() as cursor:
-        sql = (
-            "SELECT "
-            "`signature_policy_agreement_target_id` as 'agreement' "
-            "FROM `field_data_signature_resource` "
-            "LEFT JOIN `field_data_signature_policy_agreement` ON "
-            "`field_data_signature_policy_agreement`.`entity_id`"
-            " = "
-            "`field_data_signature_resource`.`entity_id`"
-            "WHERE "
-            "`field_data_signature_resource`.`signature_resource_target_id` "
-            "= %s"
-        )
-        cursor.execute(sql, (etd["nid"],))
-        rows = cursor.fetchall()
+def add_agreement(etd, rows):
     agreement_id_to_hyrax_url = {
         11: "https://repository.library.carleton.ca/concern/works/pc289j04q",
         12: "https://repository.library.carleton.ca/concern/works/j9602065z",
@@ -502,10 +565,918 @@ def add_agreement(dbc, etd):
     etd["agreement"] = SPLIT_PATTERN.join(agreements)
 
 
-@click.command()
+FIELD_SQL = {
+    "creator": CREATOR_SQL,
+    "identifier": IDENTIFIER_SQL,
+    "subjects": SUBJECTS_SQL,
+    "abstract": ABSTRACT_SQL,
+    "publisher": PUBLISHER_SQL,
+    "contributors": CONTRIBUTORS_SQL,
+    "date": DATE_SQL,
+    "language": LANGUAGE_SQL,
+    "internal_notes": INTERNAL_NOTES_SQL,
+    "degree": DEGREE_SQL,
+    "degree_discipline": DEGREE_DISCIPLINE_SQL,
+    "degree_level": DEGREE_LEVEL_SQL,
+    "pdf": PDF_SQL,
+    "supplemental_file": SUPPLEMENTAL_FILE_SQL,
+    "agreement": AGREEMENT_SQL,
+}
+
+# The fields the subject audit needs, for every ETD at once and in nid
+# order, so they can be merged with the node rows as they stream in.
+ETD_ENTITIES = "WHERE `entity_id` IN (SELECT `nid` " + ETD_CONDITIONS + ") "
+
+SUBJECT_AUDIT_SQL = {
+    "identifier": (
+        "SELECT "
+        "`entity_id` AS 'nid', "
+        "`dcterms_identifier_url` as 'identifier' "
+        "FROM `field_data_dcterms_identifier` "
+        + ETD_ENTITIES
+        + "ORDER BY `entity_id`, `delta`"
+    ),
+    "creator": (
+        "SELECT "
+        "`entity_id` AS 'nid', "
+        "`dcterms_creator_value` as 'creator' "
+        "FROM `field_data_dcterms_creator` "
+        + ETD_ENTITIES
+        + "ORDER BY `entity_id`, `delta`"
+    ),
+    "subjects": (
+        "SELECT "
+        "`entity_id` AS 'nid', "
+        "`dcterms_subject_value` as 'subject' "
+        "FROM `field_data_dcterms_subject` "
+        + ETD_ENTITIES
+        + "ORDER BY `entity_id`, `delta`"
+    ),
+}
+
+FILE_FIELDS = ("pdf", "supplemental_file")
+
+
+def add_fields(
+    etd, fields, subject_log, subject_resolver, stager, instrumentation
+):
+    nid = etd["nid"]
+    timed = instrumentation.timed
+    with timed("add_creator"):
+        add_creator(etd, fields["creator"][nid])
+    with timed("add_identifier"):
+        add_identifier(etd, fields["identifier"][nid])
+    with timed("add_subjects"):
+        add_subjects(
+            etd, fields["subjects"][nid], subject_log, subject_resolver
+        )
+    with timed("add_abstract"):
+        add_abstract(etd, fields["abstract"][nid])
+    with timed("add_publisher"):
+        add_publisher(etd, fields["publisher"][nid])
+    with timed("add_contributors"):
+        add_contributors(etd, fields["contributors"][nid])
+    with timed("add_date"):
+        add_date(etd, fields["date"][nid])
+    with timed("add_rights_notes"):
+        add_rights_notes(etd)
+    with timed("add_language"):
+        add_language(etd, fields["language"][nid])
+    with timed("add_internal_notes"):
+        add_internal_notes(etd, fields["internal_notes"][nid])
+    with timed("add_degree"):
+        add_degree(etd, fields["degree"][nid])
+    with timed("add_degree_discipline"):
+        add_degree_discipline(etd, fields["degree_discipline"][nid])
+    with timed("add_degree_level"):
+        add_degree_level(etd, fields["degree_level"][nid])
+    with timed("add_pdf_file_or_access_right"):
+        add_pdf_file_or_access_right(etd, fields["pdf"][nid], stager)
+    with timed("add_supplemental_file"):
+        add_supplemental_file(etd, fields["supplemental_file"][nid], stager)
+    with timed("add_agreement"):
+        add_agreement(etd, fields["agreement"][nid])
+
+
+def find_unchanged(pool, etds, manifest, batch_size):
+    # Compare every ETD against the manifest before anything is copied, so
+    # files left behind by changed or deleted nodes are gone before another
+    # node's file can take their name. Returns the size of the files of each
+    # unchanged ETD.
+    unchanged = {}
+    for batch, submitted in prefetched(
+        batched(etds, batch_size),
+        lambda batch: submit_fields(pool, batch, FILE_FIELDS),
+    ):
+        fields = gather_fields(submitted)
+        for etd in batch:
+            nid = etd["nid"]
+            file_rows = fields["pdf"][nid] + fields["supplemental_file"][nid]
+            if manifest.is_unchanged(etd, file_rows):
+                unchanged[nid] = file_bytes(file_rows)
+    for nid in list(manifest.previous):
+        if nid not in unchanged:
+            manifest.remove_staged_files(nid)
+    return unchanged
+
+
+HEADER_COLUMNS = [
+    "source_identifier",
+    "model",
+    "title",
+    "creator",
+    "identifier",
+    "subject",
+    "abstract",
+    "publisher",
+    "contributor",
+    "date_created",
+    "language",
+    "internal_note",
+    "degree",
+    "degree_discipline",
+    "degree_level",
+    "resource_type",
+    "parents",
+    "file",
+    "rights_notes",
+    "visibility",
+    "agreement",
+    "access_right",
+]
+
+SUBJECT_LOG_COLUMNS = ["title", "link", "doi", "creator", "action", "subject"]
+
+ERROR_COLUMNS = ["nid", "source_identifier", "title", "error"]
+
+
+def hyrax_row(etd, parent_collection_id):
+    return [
+        etd["source_identifier"],
+        "Etd",
+        etd["title"],
+        etd["creator"],
+        etd["identifier"],
+        etd["subjects"],
+        etd["abstract"],
+        etd["publisher"],
+        etd["contributors"],
+        etd["date"],
+        etd["language"],
+        etd["internal_notes"],
+        etd["degree"],
+        etd["degree_discipline"],
+        etd["degree_level"],
+        "Thesis",
+        parent_collection_id,
+        etd["file"],
+        etd["rights_notes"],
+        etd["visibility"],
+        etd["agreement"],
+        etd["access_right"],
+    ]
+
+
+def error_row(etd, error):
+    return [etd["nid"], etd["source_identifier"], etd["title"], str(error)]
+
+
+def unbuffered_cursor(dbc):
+    # Snapshot cursors always stream, so snapshot runs never load pymysql.
+    from snapshot import SnapshotConnection
+
+    if isinstance(dbc, SnapshotConnection):
+        return dbc.cursor()
+    import pymysql.cursors
+
+    return dbc.cursor(pymysql.cursors.SSDictCursor)
+
+
+def connect(params):
+    if params.get("snapshot"):
+        from snapshot import SnapshotConnection
+
+        return SnapshotConnection(params["snapshot"])
+    import pymysql
+
+    return pymysql.connect(
+        host=params["host"],
+        user=params["user"],
+        password=params["password"],
+        database=params["database"],
+        cursorclass=pymysql.cursors.DictCursor,
+    )
+
+
+def connection_pool(params, instrumentation, throttle=None):
+    from connection_pool import ConnectionPool
+
+    return ConnectionPool(
+        lambda: connect(params),
+        params["db_connections"],
+        instrumentation,
+        throttle,
+    )
+
+
+def make_throttle(params):
+    # Shards each take their share of the limits.
+    shard = params.get("shard")
+    throttle = Throttle(
+        params["read_rate"],
+        params["max_reads"],
+        params["query_rate"],
+        params["throttle_control"],
+        shard[1] if shard else 1,
+    )
+    if params["throttle_control"] is not None:
+        # SIGHUP applies a changed control file without waiting for the next
+        # check.
+        signal.signal(signal.SIGHUP, lambda *_: throttle.request_reload())
+    return throttle
+
+
+def _forward_sighup(*_):
+    import multiprocessing
+
+    for child in multiprocessing.active_children():
+        os.kill(child.pid, signal.SIGHUP)
+
+
+def load_subjects(params):
+    from subject_index import SubjectIndex
+    from subject_resolver import SubjectReport, SubjectResolver
+
+    subject_resolver = SubjectResolver(
+        SubjectIndex(params["subject_index"]), params["subject_cache"]
+    )
+    return subject_resolver, SubjectReport()
+
+
+def stream_rows(dbc, sql):
+    with unbuffered_cursor(dbc) as cursor:
+        cursor.execute(sql)
+        yield from cursor
+
+
+def merge_fields(etds, streams):
+    # Pair each ETD with its rows from every stream. The streams and the
+    # ETDs are all in nid order, so this is a merge join that never holds
+    # more than one ETD's rows.
+    groups = {
+        field: itertools.groupby(rows, key=lambda row: row["nid"])
+        for field, rows in streams.items()
+    }
+    heads = {field: next(group, None) for field, group in groups.items()}
+    for etd in etds:
+        nid = etd["nid"]
+        fields = {}
+        for field, group in groups.items():
+            head = heads[field]
+            while head is not None and head[0] < nid:
+                head = next(group, None)
+            if head is not None and head[0] == nid:
+                fields[field] = list(head[1])
+                head = next(group, None)
+            else:
+                fields[field] = []
+            heads[field] = head
+        yield etd, fields
+
+
+def audit_subjects(params, progress, instrumentation):
+    # Page through the node rows and stream the identifier, creator and
+    # subject rows of every ETD side by side, each on its own connection,
+    # instead of querying the fields batch by batch.
+    subject_resolver, subject_report = load_subjects(params)
+    counts = {"total": 0, "missing_subjects": 0}
+    with contextlib.ExitStack() as stack:
+        node_dbc = stack.enter_context(connect(params))
+        streams = {
+            field: stream_rows(stack.enter_context(connect(params)), sql)
+            for field, sql in SUBJECT_AUDIT_SQL.items()
+        }
+        subject_log_file = stack.enter_context(
+            open(params["subject_log"], "w", newline="", encoding="utf-8")
+        )
+        subject_log_writer = csv.writer(subject_log_file)
+        subject_log_writer.writerow(SUBJECT_LOG_COLUMNS)
+        for batch in batched(
+            merge_fields(get_etds(node_dbc, params["batch_size"]), streams),
+            params["batch_size"],
+        ):
+            for etd, fields in batch:
+                # identifier and creator are used in the report
+                add_identifier(etd, fields["identifier"])
+                add_creator(etd, fields["creator"])
+                subject_log = []
+                with instrumentation.timed("add_subjects"):
+                    add_subjects(
+                        etd, fields["subjects"], subject_log, subject_resolver
+                    )
+                subject_log_writer.writerows(subject_log)
+                subject_report.add(subject_log)
+                counts["total"] += 1
+                if etd["subjects"] == "":
+                    counts["missing_subjects"] += 1
+            progress(len(batch))
+    subject_resolver.save()
+    subject_report.write(params["subject_report"])
+    return counts
+
+
+def plan_extraction(params, progress, instrumentation):
+    # Check the files of every ETD the way a full run would, without copying
+    # anything. Problems are written to the plan report in the same format
+    # as the error report.
+    from concurrent.futures import ThreadPoolExecutor
+
+    throttle = make_throttle(params)
+    pool = connection_pool(params, instrumentation, throttle)
+    node_dbc = connect(params)
+    destination_path = pathlib.Path(params["destination"]).resolve()
+    layout = params["layout"]
+    drupal_root = params["drupal_root"]
+
+    def stat_source(uri):
+        # Problems are reported with the ETDs whose files they are.
+        with throttle.reading():
+            try:
+                return source_size(uri, drupal_root)
+            except ProcessingException as e:
+                return e
+
+    names = set()
+    counts = {"total": 0, "files": 0, "bytes": 0, "renamed": 0, "failed": 0}
+    with pool, node_dbc, ThreadPoolExecutor(
+        max_workers=params["staging_workers"]
+    ) as executor, open(
+        params["plan_report"], "w", newline="", encoding="utf-8"
+    ) as plan_file:
+        plan_writer = csv.writer(plan_file)
+        plan_writer.writerow(ERROR_COLUMNS)
+        for batch, submitted in prefetched(
+            batched(
+                get_etds(node_dbc, params["batch_size"]), params["batch_size"]
+            ),
+            lambda batch: submit_fields(pool, batch, FILE_FIELDS),
+        ):
+            fields = gather_fields(submitted)
+            # Stat the sources of the whole batch at once.
+            uris = sorted(
+                {
+                    row["uri"]
+                    for field in FILE_FIELDS
+                    for rows in fields[field].values()
+                    for row in rows
+                    if row["uri"] is not None
+                }
+            )
+            with instrumentation.timed("stat_sources"):
+                sizes = dict(
+                    zip(
+                        uris,
+                        executor.map(stat_source, uris),
+                    )
+                )
+            for etd in batch:
+                nid = etd["nid"]
+                problems = []
+                for field, label in (
+                    ("pdf", "pdf file"),
+                    ("supplemental_file", "supplemental file"),
+                ):
+                    if len(fields[field][nid]) > 1:
+                        problems.append(
+                            f"ERROR - {etd} has more than one {label}."
+                        )
+                etd_names = []
+                etd_bytes = 0
+                etd_renamed = 0
+                for row in (
+                    fields["pdf"][nid] + fields["supplemental_file"][nid]
+                ):
+                    try:
+                        check_file_row(row)
+                    except ProcessingException as e:
+                        problems.append(str(e))
+                        continue
+                    uri = row["uri"]
+                    size = sizes[uri]
+                    if isinstance(size, ProcessingException):
+                        problems.append(str(size))
+                        continue
+                    name = layout_name(
+                        layout,
+                        source_path(uri, drupal_root).name,
+                        nid,
+                        row["md5"],
+                    )
+                    if name in names:
+                        if layout == "flat":
+                            problems.append(
+                                f"ERROR - {destination_path / name} "
+                                "already copied."
+                            )
+                            continue
+                        name = deduplicated_name(name, row["fid"], names)
+                        etd_renamed += 1
+                    names.add(name)
+                    etd_names.append(name)
+                    etd_bytes += size
+                counts["total"] += 1
+                if problems:
+                    # A failed ETD's files are removed, freeing their names.
+                    names.difference_update(etd_names)
+                    counts["failed"] += 1
+                    for problem in problems:
+                        plan_writer.writerow(error_row(etd, problem))
+                else:
+                    counts["files"] += len(etd_names)
+                    counts["bytes"] += etd_bytes
+                    counts["renamed"] += etd_renamed
+            progress(len(batch))
+    return counts
+
+
+def run_extraction(params, progress, instrumentation):
+    from hash_cache import HashCache
+
+    # Connect to the database, through a pool for the field queries and once
+    # for the pages of node rows.
+    throttle = make_throttle(params)
+    pool = connection_pool(params, instrumentation, throttle)
+    node_dbc = connect(params)
+    shard = params.get("shard")
+    batch_size = params["batch_size"]
+    collect_errors = params["collect_errors"]
+    incremental = params["incremental"]
+    resume = params["resume"]
+
+    subject_resolver, subject_report = load_subjects(params)
+
+    destination_path = pathlib.Path(params["destination"]).resolve()
+    merged_path = None
+    if shard is not None:
+        merged_path = pathlib.Path(params["merged_destination"])
+    manifest = Manifest(
+        destination_path, subject_resolver.key, params["layout"]
+    )
+    journal = Journal(
+        params["journal"],
+        destination_path,
+        subject_resolver.key,
+        params["layout"],
+    )
+    resumed = set()
+    journal_length = 0
+    if incremental:
+        manifest.load(params["manifest"])
+    if resume:
+        resumed, journal_length = manifest.load(journal.path, required=True)
+    if not (incremental or resume) and destination_path.exists():
+        shutil.rmtree(destination_path)
+    os.makedirs(destination_path, exist_ok=True)
+
+    counts = {"total": 0, "missing_subjects": 0, "failed": 0, "reused": 0}
+    subject_log_file = open(
+        params["subject_log"], "w", newline="", encoding="utf-8"
+    )
+    subject_log_writer = csv.writer(subject_log_file)
+    subject_log_writer.writerow(SUBJECT_LOG_COLUMNS)
+    hyrax_import_file = open(
+        params["hyrax_import"], "w", newline="", encoding="utf-8"
+    )
+    hyrax_import_writer = csv.writer(hyrax_import_file)
+    hyrax_import_writer.writerow(HEADER_COLUMNS)
+    error_file = None
+    if collect_errors:
+        error_file = open(
+            params["error_report"], "w", newline="", encoding="utf-8"
+        )
+        error_writer = csv.writer(error_file)
+        error_writer.writerow(ERROR_COLUMNS)
+    try:
+        with pool, node_dbc, subject_log_file, hyrax_import_file, HashCache(
+            params["hash_cache"]
+        ) as hash_cache, Stager(
+            destination_path,
+            params["staging_workers"],
+            params["copy_mode"],
+            params["drupal_root"],
+            instrumentation,
+            params["layout"],
+            hash_cache,
+            throttle,
+            merged_path,
+        ) as stager:
+            unchanged = {}
+            if manifest.previous:
+                unchanged = find_unchanged(
+                    pool,
+                    get_etds(node_dbc, batch_size, shard),
+                    manifest,
+                    batch_size,
+                )
+            for nid in unchanged:
+                stager.claim(manifest.staged_names(nid))
+            if incremental or resume:
+                manifest.remove_untracked_files(stager.names)
+            journal.open(journal_length)
+            subject_logs = {}
+            etd_file_bytes = {}
+            extracted = set()
+
+            def collect(completed):
+                for etd, error in completed:
+                    nid = etd["nid"]
+                    subject_log = subject_logs.pop(nid)
+                    progress(1, etd_file_bytes.pop(nid))
+                    if error is not None:
+                        if not collect_errors:
+                            raise error
+                        counts["failed"] += 1
+                        error_writer.writerow(error_row(etd, error))
+                        continue
+                    subject_log_writer.writerows(subject_log)
+                    subject_report.add(subject_log)
+                    with instrumentation.timed("write_hyrax_row"):
+                        hyrax_import_writer.writerow(
+                            hyrax_row(etd, params["parent_collection_id"])
+                        )
+                    if nid not in resumed:
+                        journal.add(etd, subject_log)
+                    extracted.add(nid)
+                    counts["total"] += 1
+                    if etd["subjects"] == "":
+                        counts["missing_subjects"] += 1
+
+            def submit(batch):
+                fresh = [e for e in batch if e["nid"] not in unchanged]
+                stale = [
+                    e
+                    for e in batch
+                    if e["nid"] in unchanged
+                    and e["nid"] in manifest.stale_subjects
+                ]
+                return (
+                    submit_fields(pool, fresh, FIELD_SQL if fresh else ()),
+                    submit_fields(pool, stale, ("subjects",) if stale else ()),
+                )
+
+            for batch, (fresh, stale) in prefetched(
+                batched(get_etds(node_dbc, batch_size, shard), batch_size),
+                submit,
+            ):
+                fields = gather_fields(fresh)
+                if "abstract" in fields:
+                    with instrumentation.timed("normalize_abstracts"):
+                        normalize_batch_abstracts(fields["abstract"])
+                stale_subjects = gather_fields(stale)
+                if stale_subjects:
+                    fields["stale_subjects"] = stale_subjects["subjects"]
+                for etd in batch:
+                    nid = etd["nid"]
+                    subject_log = []
+                    error = None
+                    if nid in unchanged:
+                        entry = manifest.entry(nid)
+                        etd = Record(entry["record"])
+                        if nid in manifest.stale_subjects:
+                            add_subjects(
+                                etd,
+                                fields["stale_subjects"][nid],
+                                subject_log,
+                                subject_resolver,
+                            )
+                            # The journal entry has to be rewritten.
+                            resumed.discard(nid)
+                        else:
+                            subject_log = entry["subject_log"]
+                        counts["reused"] += 1
+                        etd_file_bytes[nid] = unchanged[nid]
+                    else:
+                        # Changed since it was journalled, if it was.
+                        resumed.discard(nid)
+                        etd_file_bytes[nid] = file_bytes(
+                            fields["pdf"][nid]
+                            + fields["supplemental_file"][nid]
+                        )
+                        try:
+                            add_fields(
+                                etd,
+                                fields,
+                                subject_log,
+                                subject_resolver,
+                                stager,
+                                instrumentation,
+                            )
+                        except ProcessingException as e:
+                            error = e
+                    subject_logs[nid] = subject_log
+                    # The ETD is done once its files have been copied.
+                    stager.finish(etd, error)
+                    collect(stager.completed())
+                # Keep the output on disk in step with the progress.
+                subject_log_file.flush()
+                hyrax_import_file.flush()
+            collect(stager.drain())
+    finally:
+        if error_file is not None:
+            error_file.close()
+
+    manifest.close()
+    journal.commit(params["manifest"], extracted if resume else None)
+    subject_resolver.save()
+    subject_report.write(params["subject_report"])
+    return counts
+
+
+def package_import(params):
+    # The manifest has every record of the finished import, so the packages
+    # are built from it rather than from the CSV.
+    from package import write_packages
+
+    def records():
+        for entry in read_entries(params["manifest"]):
+            etd = Record(entry["record"])
+            row = hyrax_row(etd, params["parent_collection_id"])
+            yield etd["nid"], row, etd["staged_files"]
+
+    max_bytes = None
+    if params["package_mb"] is not None:
+        max_bytes = int(params["package_mb"] * 1e6)
+    return write_packages(
+        records(),
+        pathlib.Path(params["destination"]).resolve(),
+        pathlib.Path(params["package_dir"]),
+        HEADER_COLUMNS,
+        params["package_format"],
+        params["package_records"],
+        max_bytes,
+    )
+
+
+def bag_import(params):
+    # The manifest has the MD5 of every staged file, as verified against
+    # filehash when it was copied.
+    from bag import write_bag
+
+    destination_path = pathlib.Path(params["destination"]).resolve()
+    files = (
+        (destination_path / name, name, md5)
+        for entry in read_entries(params["manifest"])
+        for name, _, md5, *_ in entry["record"]["staged_files"]
+    )
+    return write_bag(
+        files,
+        pathlib.Path(params["bag"]),
+        [
+            pathlib.Path(params["hyrax_import"]),
+            pathlib.Path(params["subject_log"]),
+        ],
+    )
+
+
+def shard_params(params, shard, shards, shards_path):
+    # Each shard stages into, and writes its outputs to, its own directory.
+    shard_path = shards_path / str(shard)
+    return dict(
+        params,
+        shard=(shard, shards),
+        destination=str(shard_path / "files"),
+        merged_destination=str(pathlib.Path(params["destination"]).resolve()),
+        manifest=str(shard_path / "manifest.jsonl"),
+        journal=str(shard_path / "journal.jsonl"),
+        error_report=str(shard_path / "errors.csv"),
+        hyrax_import=str(shard_path / "hyrax_import.csv"),
+        subject_log=str(shard_path / "subject-processing-log.csv"),
+        subject_report=str(shard_path / "subject-report.csv"),
+        subject_cache=str(shard_path / "subject-cache.json"),
+    )
+
+
+_shard_progress = None
+
+
+def _init_shard_worker(progress_queue):
+    global _shard_progress
+    _shard_progress = progress_queue
+
+
+def _report_shard_progress(etds, file_bytes=0):
+    _shard_progress.put((etds, file_bytes))
+
+
+def extract_shard(params, instrumentation):
+    # The instrumentation goes back to the parent with the counts.
+    counts = run_extraction(params, _report_shard_progress, instrumentation)
+    return counts, instrumentation
+
+
+def merge_shards(params, all_shard_params):
+    # Shards extract disjoint sets of nids in nid order, so merging their
+    # manifests by nid reproduces the order of a serial run. Files are moved
+    # into the destination in that order, so a name collision fails, or is
+    # renamed for, the same ETD it would have been serially.
+    destination_path = pathlib.Path(params["destination"]).resolve()
+    subject_resolver, subject_report = load_subjects(params)
+    journal = Journal(
+        params["journal"],
+        destination_path,
+        subject_resolver.key,
+        params["layout"],
+    )
+    journal.open()
+    counts = {"total": 0, "missing_subjects": 0, "failed": 0, "reused": 0}
+    names = set()
+    collisions = []
+    entries = heapq.merge(
+        *(read_entries(p["manifest"]) for p in all_shard_params),
+        key=lambda entry: entry["record"]["nid"],
+    )
+    with open(
+        params["subject_log"], "w", newline="", encoding="utf-8"
+    ) as subject_log_file, open(
+        params["hyrax_import"], "w", newline="", encoding="utf-8"
+    ) as hyrax_import_file:
+        subject_log_writer = csv.writer(subject_log_file)
+        subject_log_writer.writerow(SUBJECT_LOG_COLUMNS)
+        hyrax_import_writer = csv.writer(hyrax_import_file)
+        hyrax_import_writer.writerow(HEADER_COLUMNS)
+        for entry in entries:
+            etd = Record(entry["record"])
+            shard_files_path = pathlib.Path(
+                all_shard_params[etd["nid"] % len(all_shard_params)][
+                    "destination"
+                ]
+            ).resolve()
+            # Shards only saw their own names, so every file asks for the
+            # name its layout wanted again.
+            staged = etd["staged_files"]
+            taken = [f[3] for f in staged if f[3] in names]
+            if taken and params["layout"] == "flat":
+                error = ProcessingException(
+                    f"ERROR - {destination_path / taken[0]} already copied."
+                )
+                if not params["collect_errors"]:
+                    raise error
+                collisions.append(error_row(etd, error))
+                counts["failed"] += 1
+                continue
+            renamed = {}
+            for staged_file in staged:
+                shard_name, fid, _, name = staged_file
+                if name in names:
+                    name = deduplicated_name(name, fid, names)
+                names.add(name)
+                renamed[shard_name] = name
+                staged_file[0] = name
+                os.makedirs((destination_path / name).parent, exist_ok=True)
+                os.replace(
+                    shard_files_path / shard_name, destination_path / name
+                )
+            etd["file"] = SPLIT_PATTERN.join(
+                renamed.get(name, name)
+                for name in etd["file"].split(SPLIT_PATTERN)
+            )
+            subject_log_writer.writerows(entry["subject_log"])
+            subject_report.add(entry["subject_log"])
+            hyrax_import_writer.writerow(
+                hyrax_row(etd, params["parent_collection_id"])
+            )
+            journal.add(etd, entry["subject_log"])
+            counts["total"] += 1
+            if etd["subjects"] == "":
+                counts["missing_subjects"] += 1
+    if params["collect_errors"]:
+        reports = []
+        for p in all_shard_params:
+            with open(p["error_report"], newline="", encoding="utf-8") as f:
+                reader = csv.reader(f)
+                next(reader)
+                reports.append(list(reader))
+        with open(
+            params["error_report"], "w", newline="", encoding="utf-8"
+        ) as f:
+            error_writer = csv.writer(f)
+            error_writer.writerow(ERROR_COLUMNS)
+            error_writer.writerows(
+                heapq.merge(collisions, *reports, key=lambda row: int(row[0]))
+            )
+    journal.commit(params["manifest"])
+    for p in all_shard_params:
+        subject_resolver.load(p["subject_cache"])
+    subject_resolver.save()
+    subject_report.write(params["subject_report"])
+    return counts
+
+
+def extract_sharded(params, progress, instrumentation):
+    import multiprocessing
+
+    shards = params["shards"]
+    destination_path = pathlib.Path(params["destination"]).resolve()
+    shards_path = destination_path.with_name(destination_path.name + ".shards")
+    for path in (destination_path, shards_path):
+        if path.exists():
+            shutil.rmtree(path)
+    os.makedirs(destination_path)
+    all_shard_params = [
+        shard_params(params, shard, shards, shards_path)
+        for shard in range(shards)
+    ]
+    for p in all_shard_params:
+        # Every shard starts from the subjects resolved by earlier runs.
+        os.makedirs(pathlib.Path(p["subject_cache"]).parent)
+        if os.path.exists(params["subject_cache"]):
+            shutil.copyfile(params["subject_cache"], p["subject_cache"])
+    if params["throttle_control"] is not None:
+        # The shards each watch the control file, so they are the ones to
+        # tell.
+        signal.signal(signal.SIGHUP, _forward_sighup)
+    progress_queue = multiprocessing.Queue()
+    with multiprocessing.Pool(
+        shards, _init_shard_worker, (progress_queue,)
+    ) as pool:
+        results = [
+            pool.apply_async(
+                extract_shard, (p, Instrumentation(instrumentation.enabled))
+            )
+            for p in all_shard_params
+        ]
+        while not all(result.ready() for result in results):
+            try:
+                progress(*progress_queue.get(timeout=0.1))
+            except queue.Empty:
+                pass
+        shard_counts = []
+        for result in results:
+            counts, shard_instrumentation = result.get()
+            shard_counts.append(counts)
+            instrumentation.merge(shard_instrumentation)
+    counts = merge_shards(params, all_shard_params)
+    # Failures inside the shards were left out of their manifests.
+    counts["failed"] += sum(c["failed"] for c in shard_counts)
+    shutil.rmtree(shards_path)
+    return counts
+
+
+def existing_parent(path):
+    # The destination may not exist yet, so look at its nearest parent.
+    path = pathlib.Path(path).resolve()
+    while not path.exists():
+        path = path.parent
+    return path
+
+
+def free_space(path):
+    return shutil.disk_usage(str(existing_parent(path))).free
+
+
+def plan_fits(params, counts):
+    # Hard links take no space in the destination, unless the files are on
+    # another file system and have to be copied after all.
+    needed = counts["bytes"]
+    if params["copy_mode"] == "hardlink":
+        files_path = existing_parent(
+            source_path("private://", params["drupal_root"])
+        )
+        destination_path = existing_parent(params["destination"])
+        if os.stat(files_path).st_dev == os.stat(destination_path).st_dev:
+            needed = 0
+    return needed <= free_space(params["destination"])
+
+
+def print_plan(params, counts):
+    seconds = counts["bytes"] / (params["copy_rate"] * 1e6)
+    print("Total: ", counts["total"])
+    print(" Files: ", counts["files"])
+    print(" Bytes: ", counts["bytes"])
+    if params["layout"] != "flat":
+        print(" Renamed: ", counts["renamed"])
+    print(" Failed: ", counts["failed"])
+    print(" Free space: ", free_space(params["destination"]))
+    if not plan_fits(params, counts):
+        print(" Not enough free space in the destination")
+    print(
+        " Projected copy time: ",
+        datetime.timedelta(seconds=round(seconds)),
+        f"at {params['copy_rate']:g} MB/s",
+    )
+
+
+@click.group()
+def cli():
+    pass
+
+
+# extract keeps the environment variable names it had before the other
+# commands were added, such as ETD_EXTRACTOR_DESTINATION.
+@cli.command(context_settings={"auto_envvar_prefix": "ETD_EXTRACTOR"})
 @click.option("--host", default="localhost")
 @click.option("--user", default="readonly")
-@click.option("--password", prompt=True, hide_input=True)
+@click.option("--password", help="Prompted for unless --snapshot is used")
 @click.option("--database", default="drupal")
 @click.option(
     "--parent-collection-id",
@@ -522,149 +1493,393 @@ def add_agreement(dbc, etd):
     help="Process all fields or only process subjects",
     is_flag=True,
 )
+@click.option(
+    "--batch-size",
+    help="The number of ETDs to load with each set of field queries",
+    default=500,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--subject-index",
+    help="The compiled LC subject index built by refresh-subjects",
+    default="subjects.idx",
+    type=click.Path(exists=True, dir_okay=False),
+)
+@click.option(
+    "--staging-workers",
+    help="The number of files to copy and verify at the same time",
+    default=4,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--copy-mode",
+    help=(
+        "How files are staged: stream copies and hashes in one pass, "
+        "kernel, reflink and hardlink hash the source and let the OS copy"
+    ),
+    default="stream",
+    type=click.Choice(COPY_MODES),
+)
+@click.option(
+    "--layout",
+    help=(
+        "How files are arranged in the destination: flat, nid for a "
+        "directory per ETD, or hash for directories by MD5 prefix"
+    ),
+    default="flat",
+    type=click.Choice(LAYOUTS),
+)
+@click.option(
+    "--incremental",
+    help="Only extract and copy ETDs that changed since the last run",
+    is_flag=True,
+)
+@click.option(
+    "--manifest",
+    help="Where to record what was extracted, for later incremental runs",
+    default="extract-manifest.json",
+)
+@click.option(
+    "--resume",
+    help="Skip the ETDs an interrupted run already finished",
+    is_flag=True,
+)
+@click.option(
+    "--journal",
+    help="Where to record each ETD as it is finished, for --resume",
+    default="extract-journal.jsonl",
+)
+@click.option(
+    "--collect-errors",
+    help="Report bad ETDs in the error report instead of stopping",
+    is_flag=True,
+)
+@click.option(
+    "--error-report",
+    help="Where --collect-errors writes the ETDs it left out",
+    default="extract-errors.csv",
+)
+@click.option(
+    "--hyrax-import",
+    help="Where to write the Bulkrax import CSV",
+    default="hyrax_import.csv",
+)
+@click.option(
+    "--subject-log",
+    help="Where to write the subject processing log",
+    default="subject-processing-log.csv",
+)
+@click.option(
+    "--shards",
+    help="Split the ETDs by nid across this many worker processes",
+    default=1,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--db-connections",
+    help="How many connections run the field queries concurrently",
+    default=1,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--snapshot",
+    help="Read from a snapshot made by the snapshot command, not the database",
+    type=click.Path(exists=True, dir_okay=False),
+)
+@click.option(
+    "--drupal-root",
+    help="Where the Drupal files are, for resolving file URIs",
+    default=DRUPAL_ROOT,
+    type=click.Path(file_okay=False),
+)
+@click.option(
+    "--subject-report",
+    help="Where to write one row for each distinct subject",
+    default="subject-report.csv",
+)
+@click.option(
+    "--subject-cache",
+    help="Where to keep resolved subjects between runs",
+    default="subject-cache.json",
+)
+@click.option(
+    "--bag",
+    help="Also write the staged files as a BagIt bag in this directory",
+)
+@click.option(
+    "--package-dir",
+    help="Also split the import into packages for Bulkrax in this directory",
+)
+@click.option(
+    "--package-format",
+    help="Write each package as a directory, a zip file or a tar file",
+    default="dir",
+    type=click.Choice(PACKAGE_FORMATS),
+)
+@click.option(
+    "--package-records",
+    help="The most records in a package",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--package-mb",
+    help="The most MB of files in a package",
+    type=click.FloatRange(min=0, min_open=True),
+)
+@click.option(
+    "--read-rate",
+    help="Limit reading source files to this many MB/s",
+    type=click.FloatRange(min=0, min_open=True),
+)
+@click.option(
+    "--max-reads",
+    help="Limit how many source files are read at the same time",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--query-rate",
+    help="Limit the field queries to this many per second",
+    type=click.FloatRange(min=0, min_open=True),
+)
+@click.option(
+    "--throttle-control",
+    help=(
+        "A JSON file of read_rate, max_reads and query_rate that overrides "
+        "the limits while the run is going, reread on change or SIGHUP"
+    ),
+)
+@click.option(
+    "--hash-cache",
+    help="Where to keep the MD5s of verified sources between runs",
+    default="hash-cache.sqlite",
+)
+@click.option(
+    "--plan",
+    help="Check every source file and report what a full run would copy",
+    is_flag=True,
+)
+@click.option(
+    "--plan-report",
+    help="Where --plan writes the problems it finds",
+    default="extract-plan.csv",
+)
+@click.option(
+    "--copy-rate",
+    help="The copy throughput in MB/s that --plan projects the time with",
+    default=100.0,
+    type=click.FloatRange(min=0, min_open=True),
+)
+@click.option(
+    "--instrumentation-report",
+    help="Write the time and counters for each stage to this JSON file",
+)
+@click.option(
+    "--cprofile",
+    help="Write cProfile stats for the run to this file",
+)
 @click.pass_context
-def extract(
-    ctx,
-    host,
-    user,
-    password,
-    database,
-    parent_collection_id,
-    destination,
-    subjects_only,
-):
-    # Connect to the database
-    dbc = pymysql.connect(
-        host=host,
-        user=user,
-        password=password,
-        database=database,
-        cursorclass=pymysql.cursors.DictCursor,
+def extract(ctx, **params):
+    """Extract the ETDs from CURVE into a Bulkrax import"""
+    if not params["snapshot"] and params["password"] is None:
+        params["password"] = click.prompt("Password", hide_input=True)
+    if params["shards"] > 1 and (params["incremental"] or params["resume"]):
+        raise click.UsageError(
+            "--shards can't be combined with --incremental or --resume."
+        )
+    if params["plan"] and params["subjects_only"]:
+        raise click.UsageError(
+            "--plan can't be combined with --subjects-only."
+        )
+    instrumentation = Instrumentation(
+        params["instrumentation_report"] is not None
     )
+    profiler = None
+    if params["cprofile"]:
+        import cProfile
 
-    subject_processing_log_path = pathlib.Path(
-        "subject-processing-log.csv"
-    ).resolve()
-    with open(
-        subject_processing_log_path, "w", newline="", encoding="utf-8"
-    ) as csv_file:
-        csv_writer = csv.writer(csv_file)
-        csv_writer.writerow(
-            ["title", "link", "doi", "creator", "action", "subject"]
-        )
+        profiler = cProfile.Profile()
+    try:
+        dbc = connect(params)
+        with dbc:
+            etd_count = count_etds(dbc)
+            total_bytes = 0
+            if not (params["subjects_only"] or params["plan"]):
+                total_bytes = count_file_bytes(dbc)
+        done = 0
+        # Each ETD counts for its file bytes plus one, so the ETA follows
+        # the bytes left to copy rather than the ETDs left.
+        with click.progressbar(
+            length=etd_count + total_bytes, item_show_func=lambda item: item
+        ) as bar:
+
+            def progress(etds, file_bytes=0):
+                nonlocal done
+                done += etds
+                bar.update(etds + file_bytes, f"{done}/{etd_count} ETDs")
+
+            if profiler is not None:
+                profiler.enable()
+            try:
+                if params["plan"]:
+                    counts = plan_extraction(params, progress, instrumentation)
+                elif params["subjects_only"]:
+                    counts = audit_subjects(params, progress, instrumentation)
+                elif params["shards"] > 1:
+                    counts = extract_sharded(params, progress, instrumentation)
+                else:
+                    counts = run_extraction(params, progress, instrumentation)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+        if params["package_dir"] is not None and not (
+            params["plan"] or params["subjects_only"]
+        ):
+            with instrumentation.timed("package_import"):
+                counts["packages"] = package_import(params)
+        if params["bag"] is not None and not (
+            params["plan"] or params["subjects_only"]
+        ):
+            with instrumentation.timed("bag_import"):
+                counts["bagged"] = bag_import(params)
+    except Exception as e:
+        click.echo(e)
+        ctx.exit(1)
 
-    if subjects_only:
-        try:
-            with dbc:
-                etds = get_etds(dbc)
-                with click.progressbar(etds) as bar:
-                    for etd in bar:
-                        # identifier and creator are used in the report
-                        add_identifier(dbc, etd)
-                        add_creator(dbc, etd)
-                        add_subjects(dbc, etd, subject_processing_log_path)
-        except Exception as e:
-            click.echo(e)
+    if instrumentation.enabled:
+        instrumentation.write_report(params["instrumentation_report"])
+    if profiler is not None:
+        profiler.dump_stats(params["cprofile"])
+
+    if params["plan"]:
+        print_plan(params, counts)
+        if counts["failed"] or not plan_fits(params, counts):
             ctx.exit(1)
-        print("Total: ", len(etds))
-        print(
-            " Missing subjects: ",
-            sum(1 for etd in etds if etd["subjects"] == ""),
-        )
-        ctx.exit(0)
+        return
+
+    print("Total: ", counts["total"])
+    if params["incremental"] or params["resume"]:
+        print(" Reused: ", counts["reused"])
+    if params["collect_errors"]:
+        print(" Failed: ", counts["failed"])
+    print(" Missing subjects: ", counts["missing_subjects"])
+    if "packages" in counts:
+        print(" Packages: ", counts["packages"])
+    if "bagged" in counts:
+        print(" Bagged files: ", counts["bagged"])
+
+    if counts.get("failed"):
+        ctx.exit(1)
+
 
-    destination_path = pathlib.Path(destination).resolve()
-    shutil.rmtree(destination_path)
-    os.mkdir(destination_path)
+@cli.command()
+@click.option("--host", default="localhost")
+@click.option("--user", default="readonly")
+@click.option("--password", prompt=True, hide_input=True)
+@click.option("--database", default="drupal")
+@click.option(
+    "--output",
+    help="Where to write the SQLite snapshot",
+    default="curve-snapshot.sqlite",
+)
+@click.pass_context
+def snapshot(ctx, output, **params):
+    """Copy the tables the extractor reads into a local SQLite file"""
+    from snapshot import dump_snapshot, snapshot_tables
 
+    tables = snapshot_tables([ETD_CONDITIONS, *FIELD_SQL.values()])
     try:
-        with dbc:
-            etds = get_etds(dbc)
-            with click.progressbar(etds) as bar:
-                for etd in bar:
-                    add_creator(dbc, etd)
-                    add_identifier(dbc, etd)
-                    add_subjects(dbc, etd, subject_processing_log_path)
-                    add_abstract(dbc, etd)
-                    add_publisher(dbc, etd)
-                    add_contributors(dbc, etd)
-                    add_date(dbc, etd)
-                    add_rights_notes(etd)
-                    add_language(dbc, etd)
-                    add_internal_notes(dbc, etd)
-                    add_degree(dbc, etd)
-                    add_degree_discipline(dbc, etd)
-                    add_degree_level(dbc, etd)
-                    add_pdf_file_or_access_right(dbc, etd, destination_path)
-                    add_supplemental_file(dbc, etd, destination_path)
-                    add_agreement(dbc, etd),
+        with connect(params) as dbc:
+            counts = dump_snapshot(dbc, output, tables)
     except Exception as e:
         click.echo(e)
         ctx.exit(1)
+    for table in tables:
+        print(f"{table}: ", counts[table])
 
-    print("Total: ", len(etds))
-    print(
-        " Missing subjects: ", sum(1 for etd in etds if etd["subjects"] == "")
-    )
 
-    header_columns = [
-        "source_identifier",
-        "model",
-        "title",
-        "creator",
-        "identifier",
-        "subject",
-        "abstract",
-        "publisher",
-        "contributor",
-        "date_created",
-        "language",
-        "internal_note",
-        "degree",
-        "degree_discipline",
-        "degree_level",
-        "resource_type",
-        "parents",
-        "file",
-        "rights_notes",
-        "visibility",
-        "agreement",
-        "access_right",
-    ]
+@cli.command("verify-hashes")
+@click.option(
+    "--hash-cache",
+    help="The hash cache kept by extract",
+    default="hash-cache.sqlite",
+    type=click.Path(exists=True, dir_okay=False),
+)
+@click.option(
+    "--workers",
+    help="The number of files to hash at the same time",
+    default=4,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--older-than",
+    help="Only re-verify hashes verified at least this many days ago",
+    default=0.0,
+    type=click.FloatRange(min=0),
+)
+@click.option(
+    "--read-rate",
+    help="Limit reading source files to this many MB/s",
+    type=click.FloatRange(min=0, min_open=True),
+)
+@click.pass_context
+def verify_hashes_command(ctx, hash_cache, workers, older_than, read_rate):
+    """Re-hash cached sources, so files that rotted are hashed by extract"""
+    from hash_cache import HashCache, verify_hashes
 
-    with open(
-        "hyrax_import.csv", "w", newline="", encoding="utf-8"
-    ) as csv_file:
-        csv_writer = csv.writer(csv_file)
-        csv_writer.writerow(header_columns)
-        for etd in etds:
-            csv_writer.writerow(
-                [
-                    etd["source_identifier"],
-                    "Etd",
-                    etd["title"],
-                    etd["creator"],
-                    etd["identifier"],
-                    etd["subjects"],
-                    etd["abstract"],
-                    etd["publisher"],
-                    etd["contributors"],
-                    etd["date"],
-                    etd["language"],
-                    etd["internal_notes"],
-                    etd["degree"],
-                    etd["degree_discipline"],
-                    etd["degree_level"],
-                    "Thesis",
-                    parent_collection_id,
-                    etd["file"],
-                    etd["rights_notes"],
-                    etd["visibility"],
-                    etd["agreement"],
-                    etd["access_right"],
-                ]
-            )
+    counts = dict.fromkeys(("verified", "changed", "missing", "corrupt"), 0)
+    corrupt = []
+    with HashCache(hash_cache) as cache:
+        verified_before = time.time() - older_than * 24 * 60 * 60
+        entries = verify_hashes(
+            cache, workers, verified_before, Throttle(read_rate)
+        )
+        with click.progressbar(entries, label="Verifying") as bar:
+            for entry, result in bar:
+                counts[result] += 1
+                if result == "corrupt":
+                    corrupt.append(entry[1])
+    for path in corrupt:
+        print(f"ERROR - {path} no longer matches its MD5.")
+    for result, count in counts.items():
+        print(f"{result.capitalize()}: ", count)
+    if corrupt:
+        ctx.exit(1)
+
+
+@cli.command("refresh-subjects")
+@click.argument(
+    "source", type=click.Path(exists=True, dir_okay=False), nargs=1
+)
+@click.option(
+    "--output",
+    help="Where to write the compiled LC subject index",
+    default="subjects.idx",
+)
+@click.option(
+    "--header",
+    help="The ProQuest to LC mapping and local LC subjects",
+    default="subjects_header.txt",
+    type=click.Path(exists=True, dir_okay=False),
+)
+@click.option(
+    "--footer",
+    help="The closing lines for the header",
+    default="subjects_footer.txt",
+    type=click.Path(exists=True, dir_okay=False),
+)
+@click.option(
+    "--run-size",
+    help="The number of distinct labels to sort in memory at once",
+    default=1_000_000,
+    type=click.IntRange(min=1),
+)
+def refresh_subjects_command(source, output, header, footer, run_size):
+    """Compile SOURCE, a subjects.madsrdf.jsonld.gz download, into an index"""
+    from subject_index import refresh_subjects
+
+    count = refresh_subjects(source, output, header, footer, run_size)
+    print("LC subjects: ", count)
 
 
 if __name__ == "__main__":
-    extract(auto_envvar_prefix="ETD_EXTRACTOR")
+    cli(auto_envvar_prefix="ETD_EXTRACTOR")
@@ -0,0 +1,114 @@
+from concurrent.futures import ThreadPoolExecutor
+from staging import hash_file, source_identity
+from throttle import Throttle
+import sqlite3
+import threading
+import time
+
+# Verified hashes are committed in groups, so an interrupted run keeps most
+# of what it verified without a commit for every file.
+COMMIT_EVERY = 100
+
+
+class HashCache:
+    """The MD5s of source files that have been verified, by fid"""
+
+    def __init__(self, path):
+        # Shard processes share the file, and staging threads the connection.
+        self.db = sqlite3.connect(
+            str(path), timeout=60, check_same_thread=False
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS verified ("
+            "fid INTEGER PRIMARY KEY, path TEXT, size INTEGER, "
+            "mtime_ns INTEGER, inode INTEGER, md5 TEXT, verified_at REAL)"
+        )
+        self.db.commit()
+        self._lock = threading.Lock()
+        self._uncommitted = 0
+
+    def is_verified(self, fid, identity, md5):
+        with self._lock:
+            row = self.db.execute(
+                "SELECT path, size, mtime_ns, inode, md5 FROM verified "
+                "WHERE fid = ?",
+                (fid,),
+            ).fetchone()
+        return (
+            row is not None
+            and tuple(row[:4]) == identity
+            and row[4] == md5.lower()
+        )
+
+    def _changed(self):
+        self._uncommitted += 1
+        if self._uncommitted >= COMMIT_EVERY:
+            self.db.commit()
+            self._uncommitted = 0
+
+    def add(self, fid, identity, md5):
+        with self._lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO verified VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (fid, *identity, md5.lower(), time.time()),
+            )
+            self._changed()
+
+    def remove(self, fid):
+        with self._lock:
+            self.db.execute("DELETE FROM verified WHERE fid = ?", (fid,))
+            self._changed()
+
+    def entries(self, verified_before):
+        with self._lock:
+            return self.db.execute(
+                "SELECT fid, path, size, mtime_ns, inode, md5 FROM verified "
+                "WHERE verified_at < ? ORDER BY path",
+                (verified_before,),
+            ).fetchall()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def verify_entry(entry, throttle):
+    _, path, size, mtime_ns, inode, md5 = entry
+    try:
+        identity = source_identity(path)
+    except FileNotFoundError:
+        return "missing"
+    if identity != (path, size, mtime_ns, inode):
+        return "changed"
+    with throttle.reading():
+        digest = hash_file(path, throttle)
+    # A file written to while it was read hasn't rotted.
+    if source_identity(path) != identity:
+        return "changed"
+    return "verified" if digest == md5 else "corrupt"
+
+
+def verify_hashes(hash_cache, workers, verified_before, throttle=None):
+    # Re-hash the sources of the entries verified before the cutoff, on a
+    # pool of threads, and yield each entry with what was found. Only
+    # sources that still verify stay in the cache.
+    throttle = throttle or Throttle()
+    entries = hash_cache.entries(verified_before)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for entry, result in zip(
+            entries,
+            executor.map(lambda entry: verify_entry(entry, throttle), entries),
+        ):
+            fid, path, size, mtime_ns, inode, md5 = entry
+            if result == "verified":
+                hash_cache.add(fid, (path, size, mtime_ns, inode), md5)
+            else:
+                hash_cache.remove(fid)
+            yield entry, result
@@ -0,0 +1,104 @@
+import json
+import math
+import threading
+import time
+
+COUNTERS = ("queries", "rows", "bytes_copied", "bytes_hashed")
+
+
+def percentile(ordered, fraction):
+    # Nearest rank, on an already sorted list.
+    if not ordered:
+        return 0.0
+    rank = max(1, math.ceil(fraction * len(ordered)))
+    return ordered[rank - 1]
+
+
+class _Timer:
+    def __init__(self, instrumentation, stage):
+        self.instrumentation = instrumentation
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instrumentation.record(
+            self.stage, time.perf_counter() - self.start
+        )
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Instrumentation:
+    """Wall time and counters for each stage of a run"""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.durations = {}
+        self.counters = {}
+        # The staging threads and connection pool record concurrently.
+        self._lock = threading.Lock()
+
+    def timed(self, stage):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, stage)
+
+    def record(self, stage, seconds, **counters):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.durations.setdefault(stage, []).append(seconds)
+            totals = self.counters.setdefault(
+                stage, dict.fromkeys(COUNTERS, 0)
+            )
+            for name, value in counters.items():
+                totals[name] += value
+
+    def merge(self, other):
+        # Fold in what a shard recorded.
+        for stage, durations in other.durations.items():
+            self.durations.setdefault(stage, []).extend(durations)
+            totals = self.counters.setdefault(
+                stage, dict.fromkeys(COUNTERS, 0)
+            )
+            for name, value in other.counters[stage].items():
+                totals[name] += value
+
+    def report(self):
+        stages = {}
+        for stage, durations in sorted(self.durations.items()):
+            ordered = sorted(durations)
+            stages[stage] = {
+                "calls": len(ordered),
+                "seconds": sum(ordered),
+                "p50": percentile(ordered, 0.5),
+                "p95": percentile(ordered, 0.95),
+                "max": ordered[-1],
+                **self.counters[stage],
+            }
+        return stages
+
+    def write_report(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, indent=2)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
@@ -0,0 +1,198 @@
+from exceptions import ProcessingException
+import json
+import os
+import pathlib
+
+# Manifests and journals share a format: a header line naming the
+# destination, its layout and the subject index, then one JSON line per
+# extracted ETD. A run writes its journal as it goes and renames it to the
+# manifest when it finishes.
+
+
+def read_entries(path):
+    with open(path, "rb") as f:
+        f.readline()
+        for line in f:
+            yield json.loads(line)
+
+
+def _lines(f):
+    # Yields the offset and contents of each remaining line.
+    while True:
+        offset = f.tell()
+        line = f.readline()
+        if not line:
+            return
+        yield offset, line
+
+
+class Manifest:
+    """What earlier runs extracted, read lazily from their manifest files"""
+
+    def __init__(self, destination_path, subject_digest, layout="flat"):
+        self.destination_path = destination_path
+        self.subject_digest = subject_digest
+        self.layout = layout
+        # Only the offset of each entry is kept in memory.
+        self.previous = {}
+        self.stale_subjects = set()
+        self._files = []
+
+    def load(self, path, required=False):
+        # Returns the nids loaded and the length of the complete entries, so
+        # an interrupted journal can be cut back before it is appended to.
+        loaded = set()
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return loaded, 0
+        header = json.loads(f.readline() or b"null")
+        # Staged files are only reusable if they are still where they were
+        # copied to. Manifests from before layouts were added are flat.
+        if (
+            not header
+            or header["destination"] != str(self.destination_path)
+            or header.get("layout", "flat") != self.layout
+        ):
+            f.close()
+            if required:
+                raise ProcessingException(
+                    f"ERROR - {path} was written for another destination "
+                    "or layout."
+                )
+            return loaded, 0
+        self._files.append(f)
+        stale = header["subject_digest"] != self.subject_digest
+        valid_length = f.tell()
+        for line in iter(f.readline, b""):
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                entry = None
+            if entry is None or not line.endswith(b"\n"):
+                # The run was interrupted while writing this line.
+                break
+            nid = entry["record"]["nid"]
+            self.previous[nid] = (f, valid_length)
+            loaded.add(nid)
+            if stale:
+                self.stale_subjects.add(nid)
+            else:
+                self.stale_subjects.discard(nid)
+            valid_length = f.tell()
+        return loaded, valid_length
+
+    def entry(self, nid):
+        f, offset = self.previous[nid]
+        f.seek(offset)
+        return json.loads(f.readline())
+
+    def is_unchanged(self, etd, file_rows):
+        if etd["nid"] not in self.previous:
+            return False
+        entry = self.entry(etd["nid"])
+        if entry["changed"] != etd["changed"]:
+            return False
+        record = entry["record"]
+        # Entries from before layouts were added have no requested name.
+        staged = sorted(
+            [fid, md5] for _, fid, md5, *_ in record["staged_files"]
+        )
+        current = sorted([row["fid"], row["md5"]] for row in file_rows)
+        if staged != current:
+            return False
+        return all(
+            (self.destination_path / name).exists()
+            for name, *_ in record["staged_files"]
+        )
+
+    def staged_names(self, nid):
+        record = self.entry(nid)["record"]
+        return [name for name, *_ in record["staged_files"]]
+
+    def remove_staged_files(self, nid):
+        for name in self.staged_names(nid):
+            try:
+                os.remove(self.destination_path / name)
+            except FileNotFoundError:
+                pass
+        del self.previous[nid]
+
+    def remove_untracked_files(self, keep):
+        # Anything else in the destination was left by an interrupted run.
+        for path in list(self.destination_path.rglob("*")):
+            name = path.relative_to(self.destination_path).as_posix()
+            if path.is_file() and name not in keep:
+                os.remove(path)
+        # Along with directories the layout no longer uses.
+        for path in sorted(self.destination_path.rglob("*"), reverse=True):
+            if path.is_dir() and not any(path.iterdir()):
+                path.rmdir()
+
+    def close(self):
+        for f in self._files:
+            f.close()
+
+
+class Journal:
+    """Records each ETD as soon as it is extracted, so a run can resume"""
+
+    def __init__(self, path, destination_path, subject_digest, layout="flat"):
+        self.path = pathlib.Path(path)
+        self.destination_path = destination_path
+        self.subject_digest = subject_digest
+        self.layout = layout
+        self.f = None
+
+    def open(self, valid_length=0):
+        if valid_length:
+            self.f = open(self.path, "a", encoding="utf-8")
+            self.f.truncate(valid_length)
+        else:
+            self.f = open(self.path, "w", encoding="utf-8")
+            self.f.write(self._header())
+
+    def _header(self):
+        header = {
+            "destination": str(self.destination_path),
+            "layout": self.layout,
+            "subject_digest": self.subject_digest,
+        }
+        return json.dumps(header) + "\n"
+
+    def add(self, etd, subject_log):
+        entry = {
+            "changed": etd["changed"],
+            "record": dict(etd),
+            "subject_log": subject_log,
+        }
+        self.f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.f.flush()
+
+    def commit(self, manifest_path, nids=None):
+        # Everything this run extracted is in the journal, which becomes the
+        # manifest for the next run.
+        self.f.close()
+        if nids is not None:
+            self._compact(nids)
+        os.replace(self.path, manifest_path)
+
+    def _compact(self, nids):
+        # A resumed run appends to the journal of the interrupted one, so
+        # ETDs extracted again have more than one entry, and ETDs that have
+        # since failed or been deleted still have theirs. Keep only the last
+        # entry of each of nids, in nid order, under a current header.
+        offsets = {}
+        partial_path = str(self.path) + ".partial"
+        with open(self.path, "rb") as f:
+            f.readline()
+            for offset, line in _lines(f):
+                nid = json.loads(line)["record"]["nid"]
+                if nid in nids:
+                    offsets[nid] = offset
+            with open(partial_path, "wb") as out:
+                out.write(self._header().encode("utf-8"))
+                for nid in sorted(offsets):
+                    f.seek(offsets[nid])
+                    out.write(f.readline())
+        os.replace(partial_path, self.path)
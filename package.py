@@ -0,0 +1,173 @@
+from exceptions import ProcessingException
+from staging import link_file
+import csv
+import hashlib
+import io
+import json
+import os
+import shutil
+
+PACKAGE_FORMATS = ("dir", "zip", "tar")
+
+BUFFER_SIZE = 1 << 20
+
+
+class _HashingReader(io.RawIOBase):
+    """Hashes a file as tarfile reads it"""
+
+    def __init__(self, f):
+        self.f = f
+        self.hash_md5 = hashlib.md5()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.f.readinto(b)
+        self.hash_md5.update(memoryview(b)[:n])
+        return n
+
+
+def _check_hash(path, digest, md5):
+    if digest.lower() != md5.lower():
+        raise ProcessingException(f"ERROR - {path} has the wrong hash.")
+
+
+class _Package:
+    """One batch of the import: a CSV and the files its rows name"""
+
+    def __init__(self, path, archive_format, header_columns):
+        self.path = path
+        self.archive_format = archive_format
+        self.records = 0
+        self.bytes = 0
+        self.nids = []
+        self.rows = io.StringIO()
+        self.writer = csv.writer(self.rows)
+        self.writer.writerow(header_columns)
+        if archive_format == "dir":
+            os.makedirs(path / "files")
+            self.archive = None
+        elif archive_format == "zip":
+            import zipfile
+
+            self.archive = zipfile.ZipFile(
+                self.partial_path, "w", zipfile.ZIP_STORED, allowZip64=True
+            )
+        else:
+            import tarfile
+
+            self.archive = tarfile.open(self.partial_path, "w")
+
+    @property
+    def partial_path(self):
+        return str(self.path) + ".partial"
+
+    def add(self, nid, row, files):
+        # files are (path, name, md5), with name relative to files/.
+        for path, name, md5 in files:
+            self.bytes += self._add_file(path, "files/" + name, md5)
+        self.writer.writerow(row)
+        self.nids.append(nid)
+        self.records += 1
+
+    def _add_file(self, path, arcname, md5):
+        size = os.path.getsize(path)
+        if self.archive is None:
+            link_file(path, self.path / arcname)
+        elif self.archive_format == "zip":
+            hash_md5 = hashlib.md5()
+            with open(path, "rb") as src, self.archive.open(
+                arcname, "w", force_zip64=True
+            ) as dst:
+                for chunk in iter(lambda: src.read(BUFFER_SIZE), b""):
+                    hash_md5.update(chunk)
+                    dst.write(chunk)
+            _check_hash(path, hash_md5.hexdigest(), md5)
+        else:
+            with open(path, "rb") as src:
+                reader = _HashingReader(src)
+                tarinfo = self.archive.gettarinfo(path, arcname)
+                self.archive.addfile(
+                    tarinfo, io.BufferedReader(reader, BUFFER_SIZE)
+                )
+            _check_hash(path, reader.hash_md5.hexdigest(), md5)
+        return size
+
+    def close(self):
+        csv_bytes = self.rows.getvalue().encode("utf-8")
+        if self.archive is None:
+            with open(self.path / "hyrax_import.csv", "wb") as f:
+                f.write(csv_bytes)
+            return
+        if self.archive_format == "zip":
+            self.archive.writestr("hyrax_import.csv", csv_bytes)
+        else:
+            import tarfile
+
+            tarinfo = tarfile.TarInfo("hyrax_import.csv")
+            tarinfo.size = len(csv_bytes)
+            self.archive.addfile(tarinfo, io.BytesIO(csv_bytes))
+        self.archive.close()
+        os.replace(self.partial_path, self.path)
+
+    def describe(self):
+        return {
+            "name": self.path.name,
+            "records": self.records,
+            "bytes": self.bytes,
+            "nids": self.nids,
+        }
+
+
+def write_packages(
+    records,
+    destination_path,
+    output_path,
+    header_columns,
+    archive_format="dir",
+    max_records=None,
+    max_bytes=None,
+):
+    # Split the import into packages of at most max_records records and
+    # max_bytes of files, so each can be imported, and retried, on its own.
+    # records yields (nid, row, staged files) in import order. A record
+    # bigger than max_bytes gets a package to itself. Returns the number of
+    # packages, which are listed in packages.json.
+    if output_path.exists():
+        shutil.rmtree(output_path)
+    os.makedirs(output_path)
+    suffix = "" if archive_format == "dir" else f".{archive_format}"
+    packages = []
+    current = None
+    for nid, row, staged_files in records:
+        files = [
+            (destination_path / name, name, md5)
+            for name, _, md5, *_ in staged_files
+        ]
+        size = sum(os.path.getsize(path) for path, _, _ in files)
+        if current is not None and (
+            (max_records and current.records >= max_records)
+            or (max_bytes and current.bytes + size > max_bytes)
+        ):
+            current.close()
+            current = None
+        if current is None:
+            name = f"package-{len(packages) + 1:04d}{suffix}"
+            current = _Package(
+                output_path / name, archive_format, header_columns
+            )
+            packages.append(current)
+        current.add(nid, row, files)
+    if current is not None:
+        current.close()
+    with open(output_path / "packages.json", "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "format": archive_format,
+                "packages": [p.describe() for p in packages],
+            },
+            f,
+            indent=2,
+        )
+    return len(packages)
@@ -0,0 +1,104 @@
+import sys
+
+RIGHTS_NOTES = (
+    "Copyright © {year} the author(s). Theses may be used for "
+    "non-commercial research, educational, or related academic purposes  "
+    "only. Such uses include personal study, research, scholarship, and "
+    "teaching. Theses may only be shared by linking to Carleton "
+    "University Institutional Repository and no part may be used without "
+    "proper attribution to the author. No part may be used for commercial"
+    " purposes directly or indirectly via a for-profit platform; no "
+    "adaptation or derivative works are permitted without consent from "
+    "the copyright owner."
+)
+
+# The fields of an ETD, in the order they are filled in. The rights notes
+# are only kept as their year.
+FIELDS = (
+    "nid",
+    "source_identifier",
+    "title",
+    "changed",
+    "visibility",
+    "creator",
+    "identifier",
+    "subjects",
+    "abstract",
+    "publisher",
+    "contributors",
+    "date",
+    "rights_year",
+    "language",
+    "internal_notes",
+    "degree",
+    "degree_discipline",
+    "degree_level",
+    "file",
+    "access_right",
+    "staged_files",
+    "agreement",
+)
+
+_FIELDS = frozenset(FIELDS)
+
+# Fields with few distinct values, so records share one copy of each.
+INTERNED_FIELDS = frozenset(
+    (
+        "visibility",
+        "publisher",
+        "language",
+        "degree",
+        "degree_discipline",
+        "degree_level",
+        "access_right",
+        "agreement",
+    )
+)
+
+
+class Record:
+    """An ETD, with a slot for each field instead of a dict"""
+
+    __slots__ = FIELDS
+
+    def __init__(self, fields=None):
+        for name, value in (fields or {}).items():
+            if name == "rights_notes":
+                # Records from before the notes were rendered when needed.
+                self.rights_year = fields["date"][:4]
+            else:
+                self[name] = value
+
+    def __getitem__(self, name):
+        if name == "rights_notes":
+            return RIGHTS_NOTES.format(year=self["rights_year"])
+        if name not in _FIELDS:
+            raise KeyError(name)
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name) from None
+
+    def __setitem__(self, name, value):
+        if name not in _FIELDS:
+            raise KeyError(name)
+        if name in INTERNED_FIELDS and isinstance(value, str):
+            value = sys.intern(value)
+        setattr(self, name, value)
+
+    def __contains__(self, name):
+        return name in _FIELDS and hasattr(self, name)
+
+    def keys(self):
+        # What dict(record) copies, for the journal.
+        return [name for name in FIELDS if hasattr(self, name)]
+
+    def __repr__(self):
+        # The same as the dict the fields used to be kept in.
+        fields = {}
+        for name in self.keys():
+            if name == "rights_year":
+                fields["rights_notes"] = self["rights_notes"]
+            else:
+                fields[name] = self[name]
+        return repr(fields)
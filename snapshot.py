@@ -0,0 +1,156 @@
+import datetime
+import decimal
+import os
+import re
+import sqlite3
+
+TABLE_NAME = re.compile(r"(?:FROM|JOIN) `(\w+)`")
+
+# Columns that the extractor's queries join or filter on.
+INDEXED_COLUMNS = (
+    "entity_id",
+    "fid",
+    "nid",
+    "type",
+    "signature_resource_target_id",
+)
+
+PLACEHOLDER = re.compile(r"%s|%%")
+
+
+def snapshot_tables(queries):
+    tables = set()
+    for sql in queries:
+        tables.update(TABLE_NAME.findall(sql))
+    return sorted(tables)
+
+
+def _sqlite_value(value):
+    if isinstance(value, (decimal.Decimal, datetime.date)):
+        return str(value)
+    return value
+
+
+def dump_snapshot(dbc, snapshot_path, tables, fetch_size=10000):
+    # Copy the tables into a new SQLite file, then move it into place, so an
+    # interrupted dump never leaves a partial snapshot behind.
+    import pymysql.cursors
+
+    partial_path = str(snapshot_path) + ".partial"
+    if os.path.exists(partial_path):
+        os.remove(partial_path)
+    sqlite = sqlite3.connect(partial_path)
+    counts = {}
+    with sqlite:
+        for table in tables:
+            with dbc.cursor(pymysql.cursors.SSDictCursor) as cursor:
+                cursor.execute(f"SELECT * FROM `{table}`")
+                columns = [d[0] for d in cursor.description]
+                sqlite.execute(
+                    f'CREATE TABLE "{table}" ('
+                    + ", ".join(f'"{c}"' for c in columns)
+                    + ")"
+                )
+                insert = (
+                    f'INSERT INTO "{table}" VALUES ('
+                    + ", ".join("?" * len(columns))
+                    + ")"
+                )
+                counts[table] = 0
+                while True:
+                    rows = cursor.fetchmany(fetch_size)
+                    if not rows:
+                        break
+                    sqlite.executemany(
+                        insert,
+                        (
+                            [_sqlite_value(row[c]) for c in columns]
+                            for row in rows
+                        ),
+                    )
+                    counts[table] += len(rows)
+            for column in INDEXED_COLUMNS:
+                if column in columns:
+                    sqlite.execute(
+                        f'CREATE INDEX "{table}_{column}" '
+                        f'ON "{table}" ("{column}")'
+                    )
+    sqlite.close()
+    os.replace(partial_path, snapshot_path)
+    return counts
+
+
+class SnapshotCursor:
+    """Runs the extractor's MySQL queries against a snapshot"""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, params=None):
+        # Translate pymysql's format placeholders, expanding a tuple into a
+        # list for IN, the way pymysql escapes it.
+        params = list(params or ())
+        values = []
+
+        def placeholder(match):
+            if match.group() == "%%":
+                return "%"
+            param = params.pop(0)
+            if isinstance(param, (tuple, list)):
+                values.extend(param)
+                return "(" + ", ".join("?" * len(param)) + ")"
+            values.append(param)
+            return "?"
+
+        if params:
+            sql = PLACEHOLDER.sub(placeholder, sql)
+        self.cursor.execute(sql, values)
+
+    def _row(self, row):
+        return {d[0]: value for d, value in zip(self.cursor.description, row)}
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        return None if row is None else self._row(row)
+
+    def fetchmany(self, size):
+        return [self._row(row) for row in self.cursor.fetchmany(size)]
+
+    def fetchall(self):
+        return [self._row(row) for row in self.cursor.fetchall()]
+
+    def __iter__(self):
+        for row in self.cursor:
+            yield self._row(row)
+
+    def close(self):
+        self.cursor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SnapshotConnection:
+    """A read-only connection to a snapshot that stands in for pymysql"""
+
+    def __init__(self, snapshot_path):
+        # Pool connections are handed between threads, one at a time.
+        self.sqlite = sqlite3.connect(
+            f"file:{snapshot_path}?mode=ro", uri=True, check_same_thread=False
+        )
+
+    def cursor(self, cursorclass=None):
+        # Rows are always returned as dicts, and sqlite3 cursors stream.
+        return SnapshotCursor(self.sqlite.cursor())
+
+    def close(self):
+        self.sqlite.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,375 @@
+from exceptions import ProcessingException
+from instrumentation import Instrumentation
+from throttle import Throttle
+import collections
+import errno
+import fcntl
+import hashlib
+import os
+import pathlib
+import shutil
+import stat
+import threading
+import time
+
+
+DRUPAL_ROOT = "/var/www/drupal/drupal-root"
+
+
+def source_path(uri, drupal_root=DRUPAL_ROOT):
+    return pathlib.Path(drupal_root) / uri.replace(
+        "private://", "sites/default/files/private/"
+    ).replace("public://", "sites/default/files/")
+
+
+def source_size(uri, drupal_root=DRUPAL_ROOT):
+    # Raises a ProcessingException for a source that a run couldn't copy.
+    try:
+        source_stat = os.stat(source_path(uri, drupal_root))
+    except (FileNotFoundError, NotADirectoryError):
+        raise ProcessingException(f"ERROR - {uri} doesn't exist.")
+    except OSError as e:
+        raise ProcessingException(f"ERROR - {uri} can't be read: {e}")
+    if stat.S_ISDIR(source_stat.st_mode):
+        raise ProcessingException(f"ERROR - {uri} is a directory.")
+    return source_stat.st_size
+
+
+def source_identity(path):
+    # A source whose path, size, modification time and inode are unchanged
+    # is taken to still have the contents that were hashed.
+    source_stat = os.stat(path)
+    return (
+        str(path),
+        source_stat.st_size,
+        source_stat.st_mtime_ns,
+        source_stat.st_ino,
+    )
+
+
+BUFFER_SIZE = 1 << 20
+
+THROTTLED_CHUNK_SIZE = 8 * BUFFER_SIZE
+
+# The Linux ioctl that asks the filesystem to share the source's extents.
+FICLONE = 0x40049409
+
+COPY_MODES = ("stream", "kernel", "reflink", "hardlink")
+
+LAYOUTS = ("flat", "nid", "hash")
+
+_buffers = threading.local()
+
+
+def _buffer():
+    # Each worker thread reuses one buffer for every file it copies.
+    if not hasattr(_buffers, "view"):
+        _buffers.view = memoryview(bytearray(BUFFER_SIZE))
+    return _buffers.view
+
+
+def stream_copy(file_source_path, file_destination_path, throttle=None):
+    # Hash the bytes on their way to the destination, so the copy never has
+    # to be read back.
+    hash_md5 = hashlib.md5()
+    view = _buffer()
+    with open(file_source_path, "rb") as src, open(
+        file_destination_path, "wb"
+    ) as dst:
+        for n in iter(lambda: src.readinto(view), 0):
+            if throttle is not None:
+                throttle.read(n)
+            hash_md5.update(view[:n])
+            dst.write(view[:n])
+    shutil.copymode(file_source_path, file_destination_path)
+    return hash_md5.hexdigest()
+
+
+def hash_file(file_path, throttle=None):
+    hash_md5 = hashlib.md5()
+    view = _buffer()
+    with open(file_path, "rb") as f:
+        for n in iter(lambda: f.readinto(view), 0):
+            if throttle is not None:
+                throttle.read(n)
+            hash_md5.update(view[:n])
+    return hash_md5.hexdigest()
+
+
+def kernel_copy(file_source_path, file_destination_path, throttle=None):
+    # copy_file_range and sendfile move the bytes without passing them
+    # through Python. A throttled copy moves a chunk at a time.
+    with open(file_source_path, "rb") as src, open(
+        file_destination_path, "wb"
+    ) as dst:
+        remaining = os.fstat(src.fileno()).st_size
+        use_copy_file_range = hasattr(os, "copy_file_range")
+        while remaining > 0:
+            count = remaining
+            if throttle is not None:
+                count = min(remaining, THROTTLED_CHUNK_SIZE)
+            if use_copy_file_range:
+                try:
+                    n = os.copy_file_range(src.fileno(), dst.fileno(), count)
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.ENOSYS):
+                        raise
+                    use_copy_file_range = False
+                    continue
+            else:
+                n = os.sendfile(dst.fileno(), src.fileno(), src.tell(), count)
+                src.seek(n, os.SEEK_CUR)
+            if n == 0:
+                break
+            if throttle is not None:
+                throttle.read(n)
+            remaining -= n
+    shutil.copymode(file_source_path, file_destination_path)
+
+
+def hard_link(file_source_path, file_destination_path, throttle=None):
+    # Files can't be linked across file systems, so those are copied.
+    try:
+        os.link(file_source_path, file_destination_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        kernel_copy(file_source_path, file_destination_path, throttle)
+
+
+def reflink_copy(file_source_path, file_destination_path, throttle=None):
+    # A clone only touches metadata, so only the fallback is throttled.
+    try:
+        with open(file_source_path, "rb") as src, open(
+            file_destination_path, "wb"
+        ) as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        shutil.copymode(file_source_path, file_destination_path)
+    except OSError:
+        # Not supported by this filesystem, or not on the same one.
+        kernel_copy(file_source_path, file_destination_path, throttle)
+
+
+def link_file(path, target):
+    # For copies of staged files, which were verified when they were staged.
+    os.makedirs(target.parent, exist_ok=True)
+    try:
+        os.link(path, target)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copyfile(path, target)
+
+
+def layout_name(layout, name, nid, md5):
+    # Where a file goes, relative to the destination. The nid layout keeps
+    # each ETD's files together, the hash layout spreads files evenly.
+    if layout == "nid":
+        return f"{nid % 1000:03d}/{nid}/{name}"
+    if layout == "hash":
+        return f"{md5.lower()[:2]}/{name}"
+    return name
+
+
+def deduplicated_name(name, fid, names):
+    # A file asking for a name that is already taken gets its fid added,
+    # which doesn't depend on which worker copies it first.
+    path = pathlib.PurePosixPath(name)
+    suffix = f"-{fid}"
+    n = 1
+    while True:
+        candidate = str(path.with_name(f"{path.stem}{suffix}{path.suffix}"))
+        if candidate not in names:
+            return candidate
+        n += 1
+        suffix = f"-{fid}-{n}"
+
+
+def copy_file(
+    uri,
+    file_source_path,
+    file_destination_path,
+    md5,
+    copy_mode,
+    verified=False,
+    throttle=None,
+    reported_path=None,
+):
+    if not file_source_path.exists():
+        raise ProcessingException(f"ERROR - {uri} doesn't exist.")
+    if copy_mode == "stream" and not verified:
+        digest = stream_copy(file_source_path, file_destination_path, throttle)
+    else:
+        # The other modes never see the bytes, so the source is checked
+        # against filehash instead of reading back the copy. A source that
+        # was verified on an earlier run isn't read at all.
+        if verified:
+            digest = md5
+        else:
+            digest = hash_file(file_source_path, throttle)
+        if copy_mode == "hardlink":
+            hard_link(file_source_path, file_destination_path, throttle)
+        elif copy_mode == "reflink":
+            reflink_copy(file_source_path, file_destination_path, throttle)
+        else:
+            kernel_copy(file_source_path, file_destination_path, throttle)
+    if digest.lower() != md5.lower():
+        raise ProcessingException(
+            f"ERROR - {reported_path or file_destination_path} "
+            "has the wrong hash."
+        )
+    return os.path.getsize(file_destination_path)
+
+
+class Stager:
+    """Copies ETD files into the destination on a pool of worker threads"""
+
+    def __init__(
+        self,
+        destination_path,
+        workers,
+        copy_mode="stream",
+        drupal_root=DRUPAL_ROOT,
+        instrumentation=None,
+        layout="flat",
+        hash_cache=None,
+        throttle=None,
+        reported_path=None,
+    ):
+        self.destination_path = destination_path
+        # Errors name files by where they end up, which for a shard is the
+        # destination it is merged into.
+        self.reported_path = reported_path or destination_path
+        self.copy_mode = copy_mode
+        self.layout = layout
+        self.hash_cache = hash_cache
+        self.throttle = throttle or Throttle()
+        self.drupal_root = drupal_root
+        self.instrumentation = instrumentation or Instrumentation(False)
+        # concurrent.futures is slow to import, so only runs that stage
+        # files load it.
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # Bound the number of ETDs in flight, so the metadata queries can
+        # only run a little ahead of the copies.
+        self.max_pending = workers * 4
+        self.names = set()
+        self.directories = set()
+        self.staged = []
+        self.pending = collections.deque()
+
+    def _copy(self, uri, fid, file_source_path, file_destination_path, md5):
+        start = time.perf_counter()
+        verified = False
+        if self.hash_cache is not None and file_source_path.exists():
+            identity = source_identity(file_source_path)
+            verified = self.hash_cache.is_verified(fid, identity, md5)
+        with self.throttle.reading():
+            size = copy_file(
+                uri,
+                file_source_path,
+                file_destination_path,
+                md5,
+                self.copy_mode,
+                verified,
+                self.throttle,
+                self.reported_path
+                / file_destination_path.relative_to(self.destination_path),
+            )
+        if self.hash_cache is not None and not verified:
+            self.hash_cache.add(fid, identity, md5)
+        # Hard links copy nothing, and verified sources aren't hashed.
+        linked = self.copy_mode == "hardlink" and os.path.samefile(
+            file_source_path, file_destination_path
+        )
+        self.instrumentation.record(
+            "copy_file",
+            time.perf_counter() - start,
+            bytes_copied=0 if linked else size,
+            bytes_hashed=0 if verified else size,
+        )
+
+    def stage(self, uri, md5, nid, fid):
+        # Returns the staged file's path relative to the destination, and
+        # the path the layout asked for.
+        if md5 is None:
+            # Checked before the name, which the hash layout takes from it.
+            raise ProcessingException(f"ERROR - {uri} has no filehash.")
+        file_source_path = source_path(uri, self.drupal_root)
+        requested = layout_name(self.layout, file_source_path.name, nid, md5)
+        name = requested
+        # Names are claimed here rather than checked on disk, since another
+        # worker may still be copying a file with the same name.
+        if name in self.names:
+            if self.layout == "flat":
+                raise ProcessingException(
+                    f"ERROR - {self.reported_path / name} already copied."
+                )
+            name = deduplicated_name(name, fid, self.names)
+        self.names.add(name)
+        file_destination_path = self.destination_path / name
+        if file_destination_path.parent not in self.directories:
+            os.makedirs(file_destination_path.parent, exist_ok=True)
+            self.directories.add(file_destination_path.parent)
+        future = self.executor.submit(
+            self._copy, uri, fid, file_source_path, file_destination_path, md5
+        )
+        self.staged.append((name, future))
+        return name, requested
+
+    def claim(self, names):
+        # Names already in the destination from an earlier run.
+        self.names.update(names)
+
+    def finish(self, etd, error=None):
+        # Everything staged since the last call belongs to this ETD. An ETD
+        # that failed before all its files were staged is passed with the
+        # error, so its copies are still waited for and cleaned up.
+        self.pending.append((etd, self.staged, error))
+        self.staged = []
+        if len(self.pending) > self.max_pending:
+            from concurrent.futures import wait
+
+            wait([future for _, future in self.pending[0][1]])
+
+    def _discard(self, staged):
+        for name, _ in staged:
+            try:
+                os.remove(self.destination_path / name)
+            except FileNotFoundError:
+                pass
+            self.names.discard(name)
+
+    def completed(self):
+        # Yield (etd, error) for ETDs whose copies have all finished, in the
+        # order they were finished. The files of a failed ETD are removed.
+        while self.pending and all(
+            future.done() for _, future in self.pending[0][1]
+        ):
+            etd, staged, error = self.pending.popleft()
+            for _, future in staged:
+                if error is None and not future.cancelled():
+                    error = future.exception()
+            if error is not None:
+                self._discard(staged)
+            yield etd, error
+
+    def drain(self):
+        from concurrent.futures import wait
+
+        while self.pending:
+            wait([future for _, future in self.pending[0][1]])
+            yield from self.completed()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        # Anything still queued after an error is not worth copying.
+        for _, future in self.staged:
+            future.cancel()
+        for _, staged, _ in self.pending:
+            for _, future in staged:
+                future.cancel()
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,558 @@
+from array import array
+import ast
+import collections
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
+import mmap
+import pathlib
+import re
+import struct
+import sys
+import tempfile
+import unicodedata
+
+# The index file is a header followed by 8-byte aligned sections. The header
+# points at a JSON table of contents written after the last section, so new
+# sections can be added without changing the layout of existing ones.
+MAGIC = b"ETDSUBJ1"
+HEADER = struct.Struct("<8sQQ")
+OFFSET = struct.Struct("<Q")
+ALIGNMENT = 8
+
+GRAPH_KEY = re.compile(r'"@graph"\s*:\s*\[')
+
+NON_WORD = re.compile(r"[\W_]+")
+
+# Near matches are gathered from the rarest tokens of a subject first, up
+# to this many labels. Postings of commoner tokens are intersected instead.
+# The best of those by shared tokens are ranked by edit distance.
+CANDIDATE_LIMIT = 20000
+RANKED_CANDIDATES = 50
+# Misspelt tokens are looked for among the indexed tokens that share their
+# first few characters.
+TOKEN_PREFIX = 4
+MAX_PREFIX_TOKENS = 500
+# Suggestions may differ from the subject in at most this share of their
+# characters.
+MAX_DISTANCE = 0.5
+# Bumped whenever near matches are picked differently, so answers cached
+# with the old suggestions are thrown away.
+NEAR_MATCHES_VERSION = 3
+
+
+def match_key(text):
+    # Casefolded, without diacritics and with punctuation as spaces, so
+    # "Québec -- History." and "Quebec--history" share a key.
+    text = unicodedata.normalize("NFKD", text.casefold())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(NON_WORD.sub(" ", text).split())
+
+
+def match_tokens(key):
+    # Single characters are kept, since they may be all that tells two
+    # labels apart.
+    return set(key.split())
+
+
+def edit_distance(a, b, limit=None):
+    # Levenshtein distance, only computed within limit of the diagonal.
+    # Anything further apart than limit comes back as limit + 1.
+    if limit is None:
+        limit = max(len(a), len(b))
+    too_far = limit + 1
+    if abs(len(a) - len(b)) > limit:
+        return too_far
+    previous = [min(j, too_far) for j in range(len(b) + 1)]
+    for i, ca in enumerate(a, 1):
+        current = [too_far] * (len(b) + 1)
+        if i <= limit:
+            current[0] = i
+        low = max(1, i - limit)
+        high = min(len(b), i + limit)
+        row_min = current[low - 1]
+        for j in range(low, high + 1):
+            # Inline comparisons, this is the inner loop of the ranking.
+            distance = previous[j - 1] + (ca != b[j - 1])
+            if previous[j] < distance:
+                distance = previous[j] + 1
+            if current[j - 1] < distance:
+                distance = current[j - 1] + 1
+            if distance > too_far:
+                distance = too_far
+            current[j] = distance
+            if distance < row_min:
+                row_min = distance
+        if row_min > limit:
+            return too_far
+        previous = current
+    return previous[-1]
+
+
+class IndexWriter:
+    """Writes the sections of a subject index file"""
+
+    def __init__(self, f):
+        self.f = f
+        self.sections = {}
+        self.f.write(b"\0" * HEADER.size)
+
+    def _align(self):
+        padding = -self.f.tell() % ALIGNMENT
+        self.f.write(b"\0" * padding)
+
+    def add_section(self, name, chunks):
+        self._align()
+        start = self.f.tell()
+        for chunk in chunks:
+            self.f.write(chunk)
+        self.sections[name] = [start, self.f.tell() - start]
+
+    def add_array(self, name, values):
+        # Arrays are stored little-endian.
+        if sys.byteorder == "big":
+            values.byteswap()
+        self.add_section(name, [values.tobytes()])
+
+    def add_strings(self, name, strings, digest=None):
+        # Strings must arrive sorted and unique. UTF-8 preserves code point
+        # order, so the encoded strings can be binary searched as bytes.
+        offsets = array("Q", [0])
+
+        def encoded():
+            for string in strings:
+                data = string.encode("utf-8")
+                if digest is not None:
+                    digest.update(data + b"\n")
+                offsets.append(offsets[-1] + len(data))
+                yield data
+
+        self.add_section(f"{name}_data", encoded())
+        self.add_array(f"{name}_offsets", offsets)
+        return len(offsets) - 1
+
+    def add_labels(self, labels):
+        digest = hashlib.sha256()
+        count = self.add_strings("label", labels, digest)
+        return count, digest.hexdigest()
+
+    def add_near_match_index(self, pairs, name="token", postings_name=""):
+        # pairs are (token, label number), sorted and unique, see
+        # sorted_unique. Each token gets the sorted numbers of the labels
+        # that contain it.
+        posting_offsets = array("Q", [0])
+
+        def tokens():
+            for token, group in itertools.groupby(pairs, lambda p: p[0]):
+                postings = array("I", (number for _, number in group))
+                posting_offsets.append(posting_offsets[-1] + len(postings))
+                if sys.byteorder == "big":
+                    postings.byteswap()
+                postings_file.write(postings.tobytes())
+                yield token
+
+        with tempfile.TemporaryFile() as postings_file:
+            self.add_strings(name, tokens())
+            postings_file.seek(0)
+            self.add_section(
+                f"{postings_name}postings",
+                iter(lambda: postings_file.read(1 << 20), b""),
+            )
+        self.add_array(f"{postings_name}posting_offsets", posting_offsets)
+
+    def finish(self, metadata):
+        self._align()
+        table = json.dumps(
+            {"sections": self.sections, "metadata": metadata}
+        ).encode("utf-8")
+        table_offset = self.f.tell()
+        self.f.write(table)
+        self.f.seek(0)
+        self.f.write(HEADER.pack(MAGIC, table_offset, len(table)))
+
+
+def iter_graph_nodes(f, chunk_size=1 << 20):
+    # Decode the members of every "@graph" array one at a time, so the whole
+    # document never has to be held in memory.
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    in_graph = False
+    eof = False
+    while True:
+        if in_graph:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == "]":
+                in_graph = False
+                pos += 1
+                continue
+            if pos < len(buffer):
+                try:
+                    node, pos = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                else:
+                    yield node
+                    continue
+            elif eof:
+                raise ValueError("Unexpected end of file inside @graph.")
+        else:
+            match = GRAPH_KEY.search(buffer, pos)
+            if match:
+                in_graph = True
+                pos = match.end()
+                continue
+            if eof:
+                return
+            # Keep enough of the tail to catch a key split across chunks.
+            pos = max(pos, len(buffer) - 32)
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+
+def iter_authoritative_labels(nodes):
+    for node in nodes:
+        labels = node.get("madsrdf:authoritativeLabel")
+        if not isinstance(labels, list):
+            labels = [labels]
+        for label in labels:
+            if isinstance(label, dict) and label.get("@language") == "en":
+                yield label["@value"]
+
+
+def _spill(run):
+    f = tempfile.TemporaryFile("w+", encoding="utf-8")
+    for label in sorted(run):
+        f.write(json.dumps(label) + "\n")
+    f.seek(0)
+    return f
+
+
+def _read_run(f):
+    for line in f:
+        yield json.loads(line)
+
+
+def sorted_unique(labels, run_size=1_000_000):
+    # External merge sort. Up to run_size distinct labels are deduplicated in
+    # memory; larger inputs are spilled to sorted runs and merged.
+    runs = []
+    run = set()
+    for label in labels:
+        run.add(label)
+        if len(run) >= run_size:
+            runs.append(_spill(run))
+            run = set()
+    if not runs:
+        yield from sorted(run)
+        return
+    if run:
+        runs.append(_spill(run))
+    try:
+        previous = None
+        for label in heapq.merge(*(_read_run(f) for f in runs)):
+            if label != previous:
+                yield label
+                previous = label
+    finally:
+        for f in runs:
+            f.close()
+
+
+def load_subjects_header(header_path, footer_path):
+    # The header and footer are the Python source that used to wrap the
+    # generated subject list, holding proquest_to_lc and local LC headings.
+    source = pathlib.Path(header_path).read_text(
+        encoding="utf-8"
+    ) + pathlib.Path(footer_path).read_text(encoding="utf-8")
+    values = {}
+    for node in ast.parse(source).body:
+        if isinstance(node, ast.Assign):
+            for target in node.targets:
+                values[target.id] = ast.literal_eval(node.value)
+    return values["proquest_to_lc"], values["lc"]
+
+
+def build_index(index_path, labels, proquest_to_lc, run_size=1_000_000):
+    # labels must be sorted and unique, see sorted_unique. The match key
+    # and tokens of every label are spilled to disk as the labels are
+    # written, then sorted into the near-match index.
+    with open(index_path, "wb") as f, tempfile.TemporaryFile(
+        "w+", encoding="utf-8"
+    ) as token_file, tempfile.TemporaryFile(
+        "w+", encoding="utf-8"
+    ) as key_file:
+
+        def tokenized():
+            for number, label in enumerate(labels):
+                key = match_key(label)
+                key_file.write(json.dumps([key, number]) + "\n")
+                for token in match_tokens(key):
+                    token_file.write(json.dumps([token, number]) + "\n")
+                yield label
+
+        writer = IndexWriter(f)
+        count, digest = writer.add_labels(tokenized())
+        writer.add_section(
+            "proquest_to_lc",
+            [json.dumps(proquest_to_lc, ensure_ascii=False).encode("utf-8")],
+        )
+        token_file.seek(0)
+        writer.add_near_match_index(
+            sorted_unique(
+                (tuple(pair) for pair in _read_run(token_file)), run_size
+            )
+        )
+        key_file.seek(0)
+        writer.add_near_match_index(
+            sorted_unique(
+                (tuple(pair) for pair in _read_run(key_file)), run_size
+            ),
+            "key",
+            "key_",
+        )
+        writer.finish({"count": count, "digest": digest, "near_matches": 2})
+    return count
+
+
+def refresh_subjects(
+    source_path, index_path, header_path, footer_path, run_size
+):
+    proquest_to_lc, local_lc = load_subjects_header(header_path, footer_path)
+    with gzip.open(source_path, "rt", encoding="utf-8") as f:
+        labels = itertools.chain(
+            local_lc, iter_authoritative_labels(iter_graph_nodes(f))
+        )
+        return build_index(
+            index_path,
+            sorted_unique(labels, run_size),
+            proquest_to_lc,
+            run_size,
+        )
+
+
+class SubjectIndex:
+    """Read-only, memory-mapped view of a subject index file"""
+
+    def __init__(self, index_path):
+        with open(index_path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, table_offset, table_length = HEADER.unpack_from(self._mm)
+        if magic != MAGIC:
+            raise ValueError(f"{index_path} is not a subject index.")
+        table_end = table_offset + table_length
+        table = json.loads(self._mm[table_offset:table_end])
+        self._sections = table["sections"]
+        self.metadata = table["metadata"]
+        self.digest = self.metadata["digest"]
+        self._count = self.metadata["count"]
+        self.proquest_to_lc = json.loads(self.section("proquest_to_lc"))
+        self._label_offsets = None
+        # Indexes built before near matches were added have no tokens.
+        self.has_near_matches = "token_data" in self._sections
+        if self.has_near_matches:
+            self._token_count = (
+                self._sections["token_offsets"][1] // OFFSET.size - 1
+            )
+        # Nor do indexes built before labels were indexed by match key.
+        self.has_match_keys = "key_data" in self._sections
+        if self.has_match_keys:
+            self._key_count = (
+                self._sections["key_offsets"][1] // OFFSET.size - 1
+            )
+
+    def section(self, name):
+        start, length = self._sections[name]
+        end = start + length
+        return self._mm[start:end]
+
+    def _string_bytes(self, name, i):
+        start, end = struct.unpack_from(
+            "<QQ",
+            self._mm,
+            self._sections[f"{name}_offsets"][0] + i * OFFSET.size,
+        )
+        data_start = self._sections[f"{name}_data"][0]
+        start += data_start
+        end += data_start
+        return self._mm[start:end]
+
+    def _lower_bound(self, name, count, key):
+        # Binary search a table of sorted strings for the first one that
+        # isn't less than the encoded key.
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if self._string_bytes(name, middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _find(self, name, count, key):
+        i = self._lower_bound(name, count, key)
+        if i < count and self._string_bytes(name, i) == key:
+            return i
+        return None
+
+    def _label_bytes(self, i):
+        return self._string_bytes("label", i)
+
+    def _label_lengths(self, numbers):
+        # In bytes, without reading the labels. Ties can be broken over tens
+        # of thousands of labels, so the offsets are read in once.
+        if self._label_offsets is None:
+            self._label_offsets = array("Q")
+            self._label_offsets.frombytes(self.section("label_offsets"))
+            if sys.byteorder == "big":
+                self._label_offsets.byteswap()
+        offsets = self._label_offsets
+        return [offsets[i + 1] - offsets[i] for i in numbers]
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self._count:
+            raise IndexError(i)
+        return self._label_bytes(i).decode("utf-8")
+
+    def __contains__(self, label):
+        return (
+            self._find("label", self._count, label.encode("utf-8")) is not None
+        )
+
+    def _similar_tokens(self, token):
+        # The token itself if it is indexed, otherwise indexed tokens with
+        # the same prefix that are only a typo or two away.
+        i = self._find("token", self._token_count, token.encode("utf-8"))
+        if i is not None:
+            return [i]
+        if len(token) == 1:
+            return []
+        prefix = token[:TOKEN_PREFIX].encode("utf-8")
+        max_distance = 1 if len(token) < 5 else 2
+        similar = []
+        start = self._lower_bound("token", self._token_count, prefix)
+        end = min(start + MAX_PREFIX_TOKENS, self._token_count)
+        for i in range(start, end):
+            candidate = self._string_bytes("token", i)
+            if not candidate.startswith(prefix):
+                break
+            candidate = candidate.decode("utf-8")
+            if edit_distance(token, candidate, max_distance) <= max_distance:
+                similar.append(i)
+        return similar
+
+    def _postings(self, i, postings_name=""):
+        start, end = struct.unpack_from(
+            "<QQ",
+            self._mm,
+            self._sections[f"{postings_name}posting_offsets"][0]
+            + i * OFFSET.size,
+        )
+        postings = array("I")
+        postings_start = self._sections[f"{postings_name}postings"][0]
+        start = postings_start + start * postings.itemsize
+        end = postings_start + end * postings.itemsize
+        postings.frombytes(self._mm[start:end])
+        if sys.byteorder == "big":
+            postings.byteswap()
+        return postings
+
+    def near_matches(self, subject, limit=3):
+        # The labels closest to a subject, for subjects with no LC match.
+        if not self.has_near_matches:
+            return []
+        key = match_key(subject)
+        # Labels with the same match key are the closest there are.
+        exact = []
+        if self.has_match_keys:
+            i = self._find("key", self._key_count, key.encode("utf-8"))
+            if i is not None:
+                exact = list(self._postings(i, "key_"))
+        if len(exact) >= limit:
+            return [self[number] for number in exact[:limit]]
+        postings = []
+        for token in match_tokens(key):
+            similar = self._similar_tokens(token)
+            if len(similar) == 1:
+                postings.append(self._postings(similar[0]))
+            elif similar:
+                numbers = set()
+                for i in similar:
+                    numbers.update(self._postings(i))
+                postings.append(array("I", sorted(numbers)))
+        postings.sort(key=len)
+        shared = collections.Counter()
+        common = []
+        for numbers in postings:
+            if len(shared) + len(numbers) <= CANDIDATE_LIMIT:
+                shared.update(numbers)
+            else:
+                common.append(numbers)
+        # Labels sharing two or more common tokens are found by intersecting
+        # their postings, so they aren't lost to the candidate limit.
+        found = set(shared)
+        for numbers, other in itertools.combinations(common, 2):
+            found.update(set(numbers).intersection(other))
+        if found:
+            for numbers in common:
+                shared.update(found.intersection(numbers))
+        elif common:
+            # Nothing shares more than one token, so every label of the
+            # rarest one is a candidate.
+            shared.update(dict.fromkeys(common[0], 1))
+        for number in exact:
+            shared.pop(number, None)
+        ranked = [(0, 0, self[number]) for number in exact]
+        for number, count in self._best_candidates(
+            shared, len(subject.encode("utf-8"))
+        ):
+            label = self[number]
+            label_key = match_key(label)
+            cutoff = int(MAX_DISTANCE * max(len(key), len(label_key)))
+            if len(ranked) >= limit:
+                # Only closer labels than the current suggestions matter.
+                cutoff = min(cutoff, ranked[limit - 1][0])
+            distance = edit_distance(key, label_key, cutoff)
+            if distance <= cutoff:
+                ranked.append((distance, -count, label))
+                ranked.sort()
+        return [label for _, _, label in ranked[:limit]]
+
+    def _best_candidates(self, shared, length):
+        # The RANKED_CANDIDATES labels sharing the most tokens. Labels tied
+        # with the last of them are taken closest in length first, rather
+        # than in label order.
+        if len(shared) <= RANKED_CANDIDATES:
+            return shared.most_common()
+        last_count = heapq.nlargest(RANKED_CANDIDATES, shared.values())[-1]
+        best = [item for item in shared.items() if item[1] > last_count]
+        best.sort(key=lambda item: -item[1])
+        tied = [
+            number for number, count in shared.items() if count == last_count
+        ]
+        distances = [abs(n - length) for n in self._label_lengths(tied)]
+        closest = heapq.nsmallest(
+            RANKED_CANDIDATES - len(best),
+            range(len(tied)),
+            key=distances.__getitem__,
+        )
+        best.extend((tied[i], last_count) for i in closest)
+        return best
+
+    def close(self):
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,111 @@
+from subject_index import NEAR_MATCHES_VERSION
+import collections
+import csv
+import hashlib
+import json
+import os
+
+
+def process_subject(subject):
+    # Use LC standard, no spaces around double dash.
+    subject = subject.replace(" -- ", "--")
+    subject = subject.replace("-- ", "--")
+    subject = subject.replace(" --", "--")
+    # Drop trailing periods.
+    subject = subject.rstrip(".")
+    return subject
+
+
+class SubjectResolver:
+    """Maps raw subjects to LC headings, remembering each answer"""
+
+    def __init__(self, subject_index, cache_path=None):
+        self.subject_index = subject_index
+        self.cache_path = cache_path
+        # Cached answers depend on the LC labels, the near-match index and
+        # how it is searched, and the ProQuest mapping.
+        self.key = hashlib.sha256(
+            json.dumps(
+                [subject_index.metadata, NEAR_MATCHES_VERSION], sort_keys=True
+            ).encode("utf-8")
+            + subject_index.section("proquest_to_lc")
+        ).hexdigest()
+        self.resolved = {}
+        if cache_path is not None:
+            self.load(cache_path)
+
+    def load(self, path):
+        try:
+            with open(path, encoding="utf-8") as f:
+                cache = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        if cache.get("key") == self.key:
+            for subject, (headings, action) in cache["subjects"].items():
+                self.resolved[subject] = (headings, action)
+
+    def save(self):
+        if self.cache_path is None:
+            return
+        partial_path = str(self.cache_path) + ".partial"
+        with open(partial_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"key": self.key, "subjects": self.resolved},
+                f,
+                ensure_ascii=False,
+            )
+        os.replace(partial_path, self.cache_path)
+
+    def resolve(self, subject):
+        # Returns the LC headings for a stripped subject and the action for
+        # the subject log.
+        try:
+            return self.resolved[subject]
+        except KeyError:
+            pass
+        proquest_to_lc = self.subject_index.proquest_to_lc
+        if subject.lower() in proquest_to_lc:
+            headings = proquest_to_lc[subject.lower()]
+            flat_lcs = "|".join(headings)
+            action = f"Mapped from proquest to LC {flat_lcs}"
+        elif subject in self.subject_index:
+            headings = [subject]
+            action = "Exact LC match found"
+        else:
+            processed_subject = process_subject(subject)
+            if processed_subject in self.subject_index:
+                headings = [processed_subject]
+                action = f"LC match '{processed_subject}' found"
+            else:
+                headings = [subject]
+                action = "No LC match"
+                near_matches = self.subject_index.near_matches(subject)
+                if near_matches:
+                    action += f", closest LC: {'|'.join(near_matches)}"
+        self.resolved[subject] = (headings, action)
+        return headings, action
+
+
+class SubjectReport:
+    """One row per distinct raw subject, with how often it was used"""
+
+    COLUMNS = ["subject", "action", "count"]
+
+    def __init__(self):
+        self.counts = collections.Counter()
+
+    def add(self, subject_log):
+        # Subject log rows end with the action and the raw subject.
+        for row in subject_log:
+            action, subject = row[4], row[5]
+            if subject:
+                self.counts[subject, action] += 1
+
+    def write(self, path):
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(self.COLUMNS)
+            for (subject, action), count in sorted(
+                self.counts.items(), key=lambda item: (-item[1], item[0])
+            ):
+                writer.writerow([subject, action, count])
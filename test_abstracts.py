@@ -0,0 +1,121 @@
+from abstracts import SPACES, normalize_abstract, normalize_abstracts
+from bs4 import BeautifulSoup
+import pytest
+import random
+
+# Abstracts as CURVE has them, and markup the fast path has to hand over to
+# BeautifulSoup.
+CORPUS = [
+    "",
+    "Plain text.",
+    "<p>One paragraph.</p>",
+    "<p>First.</p>\r\n<p>Second.</p>",
+    "Line<br>break",
+    "Line<br/>break",
+    "Line<br />break",
+    "<br>a</br> text",
+    "a</BR>b",
+    "<p class='abstract'>Tom &amp; Jerry &lt;3 &quot;quoted&quot;</p>",
+    "Caf&#233; &#x41;&nbsp;b",
+    "&#128; is windows-1252",
+    "&bogus; entity",
+    "A & B",
+    "x < y > z",
+    "<!-- comment -->Text",
+    "<script>ignored()</script>Text",
+    "<font face='Arial'>Old markup</font>",
+    "<ul><li>One</li><li>Two</li></ul>",
+    "H<sub>2</sub>O and x<sup>2</sup>",
+    "<p/>Self-closing<b/>tags",
+    "  Spaces   inside  \t and\nnewlines  ",
+    "<div><span><em>Nested</em> <strong>tags</strong></span></div>",
+    "<P >Upper case</P>",
+    "Unclosed <b>bold",
+]
+
+PIECES = [
+    "<p>",
+    "</p>",
+    "<br>",
+    "</br>",
+    "<br/>",
+    "<br />",
+    "<BR>",
+    "</BR>",
+    "<p/>",
+    "<b>",
+    "</b>",
+    "<b/>",
+    "<i>",
+    "</i >",
+    "<span class='x'>",
+    "</span>",
+    "<div>",
+    "</div>",
+    "<li>",
+    "</li>",
+    '<p id="a">',
+    "&amp;",
+    "&lt;",
+    "&quot;",
+    "&nbsp;",
+    "&#233;",
+    "&#x41;",
+    "&#128;",
+    "&bogus;",
+    "&",
+    "<",
+    ">",
+    "<!-- c -->",
+    "<font>",
+    " ",
+    "  ",
+    "\n",
+    "\r\n",
+    "\t",
+    "\xa0",
+    "text",
+    " x ",
+    "é",
+]
+
+
+def soup_abstract(html):
+    # How abstracts were normalized before the fast path.
+    abstract = BeautifulSoup(html, "html.parser").get_text(strip=True)
+    abstract = abstract.replace("\r", "")
+    abstract = abstract.replace("\n", " ")
+    return SPACES.sub(" ", abstract)
+
+
+def random_markup(count, seed=0):
+    rng = random.Random(seed)
+    for _ in range(count):
+        yield "".join(rng.choice(PIECES) for _ in range(rng.randint(1, 12)))
+
+
+@pytest.mark.parametrize("html", CORPUS)
+def test_corpus_matches_beautifulsoup(html):
+    assert normalize_abstract(html) == soup_abstract(html)
+
+
+def test_random_markup_matches_beautifulsoup():
+    for html in random_markup(5000):
+        assert normalize_abstract(html) == soup_abstract(html), html
+
+
+def test_normalize_abstracts_normalizes_each_distinct_abstract_once(
+    monkeypatch,
+):
+    import abstracts
+
+    calls = []
+
+    def counted(html):
+        calls.append(html)
+        return normalize_abstract(html)
+
+    monkeypatch.setattr(abstracts, "normalize_abstract", counted)
+    batch = CORPUS + CORPUS[::-1] + ["<p>One paragraph.</p>"]
+    assert normalize_abstracts(batch) == [soup_abstract(h) for h in batch]
+    assert sorted(calls) == sorted(set(CORPUS))
@@ -0,0 +1,217 @@
+from benchmark import make_fixture
+from manifest import read_entries
+import extract
+import hashlib
+import pytest
+import sqlite3
+
+LAYOUTS = ["flat", "nid", "hash"]
+
+
+@pytest.fixture
+def fixture(tmp_path, monkeypatch):
+    # A small snapshot, subject index and file tree, with the stand-in
+    # internal_notes importable.
+    workdir = tmp_path / "fixture"
+    make_fixture(
+        workdir,
+        etds=40,
+        pdf_size=4096,
+        supplemental_size=1024,
+        supplemental_ratio=0.3,
+        seed=1,
+    )
+    monkeypatch.syspath_prepend(str(workdir))
+    return workdir
+
+
+def run(fixture, run_path, monkeypatch, *args):
+    # Returns the exit status.
+    run_path.mkdir(exist_ok=True)
+    monkeypatch.chdir(run_path)
+    status = extract.extract.main(
+        [
+            "--snapshot",
+            str(fixture / "curve.sqlite"),
+            "--subject-index",
+            str(fixture / "subjects.idx"),
+            "--drupal-root",
+            str(fixture / "drupal-root"),
+            "--batch-size",
+            "7",
+            "--staging-workers",
+            "4",
+            *args,
+        ],
+        standalone_mode=False,
+    )
+    return status or 0
+
+
+def outputs(run_path):
+    # Everything a run leaves behind, with its own directory taken out of
+    # the paths in error messages.
+    files_path = run_path / "files"
+    files = {
+        path.relative_to(files_path)
+        .as_posix(): hashlib.md5(path.read_bytes())
+        .hexdigest()
+        for path in files_path.rglob("*")
+        if path.is_file()
+    }
+    texts = {}
+    for name in (
+        "hyrax_import.csv",
+        "subject-processing-log.csv",
+        "subject-report.csv",
+        "extract-errors.csv",
+    ):
+        if (run_path / name).exists():
+            texts[name] = (
+                (run_path / name)
+                .read_text(encoding="utf-8")
+                .replace(str(run_path.resolve()), "")
+            )
+    return {
+        "files": files,
+        "texts": texts,
+        "manifest": list(read_entries(run_path / "extract-manifest.json")),
+    }
+
+
+def snapshot(fixture):
+    return sqlite3.connect(str(fixture / "curve.sqlite"))
+
+
+def pdf(fixture, nid):
+    # The fid, source path and MD5 of an ETD's PDF.
+    with snapshot(fixture) as db:
+        fid, uri, md5 = db.execute(
+            "SELECT `file_managed`.`fid`, `uri`, `md5` "
+            "FROM `field_data_etd_pdf` "
+            "JOIN `file_managed` ON `etd_pdf_fid` = `file_managed`.`fid` "
+            "JOIN `filehash` ON `filehash`.`fid` = `file_managed`.`fid` "
+            "WHERE `entity_id` = ?",
+            (nid,),
+        ).fetchone()
+    return fid, extract.source_path(uri, fixture / "drupal-root"), md5
+
+
+def pdf_nids(fixture):
+    with snapshot(fixture) as db:
+        return [
+            nid
+            for nid, in db.execute(
+                "SELECT `entity_id` FROM `field_data_etd_pdf` "
+                "ORDER BY `entity_id`"
+            )
+        ]
+
+
+def share_pdf_name(fixture, nids):
+    # Give the PDFs of nids the same name and contents, in different
+    # directories, so they collide in the flat and hash layouts.
+    _, first_path, md5 = pdf(fixture, nids[0])
+    data = first_path.read_bytes()
+    with snapshot(fixture) as db:
+        for i, nid in enumerate(nids):
+            fid, path, _ = pdf(fixture, nid)
+            shared_path = path.parent / f"shared-{i}" / "shared.pdf"
+            shared_path.parent.mkdir()
+            shared_path.write_bytes(data)
+            db.execute(
+                "UPDATE `file_managed` SET `uri` = ?, `filesize` = ? "
+                "WHERE `fid` = ?",
+                (f"private://shared-{i}/shared.pdf", len(data), fid),
+            )
+            db.execute(
+                "UPDATE `filehash` SET `md5` = ? WHERE `fid` = ?", (md5, fid)
+            )
+
+
+@pytest.mark.parametrize("layout", LAYOUTS)
+def test_resume_matches_full_run(fixture, tmp_path, monkeypatch, layout):
+    assert (
+        run(fixture, tmp_path / "full", monkeypatch, "--layout", layout) == 0
+    )
+    # Stop a run partway through with a missing source.
+    nids = pdf_nids(fixture)
+    _, path, _ = pdf(fixture, nids[len(nids) // 2])
+    path.rename(path.with_name("moved"))
+    resumed_path = tmp_path / "resumed"
+    assert run(fixture, resumed_path, monkeypatch, "--layout", layout) == 1
+    assert list(read_entries(resumed_path / "extract-journal.jsonl"))
+    path.with_name("moved").rename(path)
+    assert (
+        run(fixture, resumed_path, monkeypatch, "--layout", layout, "--resume")
+        == 0
+    )
+    assert outputs(resumed_path) == outputs(tmp_path / "full")
+
+
+@pytest.mark.parametrize("layout", LAYOUTS)
+def test_incremental_matches_full_run(fixture, tmp_path, monkeypatch, layout):
+    incremental_path = tmp_path / "incremental"
+    assert run(fixture, incremental_path, monkeypatch, "--layout", layout) == 0
+    nids = pdf_nids(fixture)
+    fid, path, _ = pdf(fixture, nids[3])
+    path.write_bytes(b"Replaced")
+    with snapshot(fixture) as db:
+        db.execute(
+            "UPDATE `node` SET `title` = 'Retitled', `changed` = 9999 "
+            "WHERE `nid` = ?",
+            (nids[1],),
+        )
+        db.execute("DELETE FROM `node` WHERE `nid` = ?", (nids[2],))
+        db.execute(
+            "UPDATE `filehash` SET `md5` = ? WHERE `fid` = ?",
+            (hashlib.md5(b"Replaced").hexdigest(), fid),
+        )
+    assert (
+        run(
+            fixture,
+            incremental_path,
+            monkeypatch,
+            "--layout",
+            layout,
+            "--incremental",
+        )
+        == 0
+    )
+    assert (
+        run(fixture, tmp_path / "full", monkeypatch, "--layout", layout) == 0
+    )
+    assert outputs(incremental_path) == outputs(tmp_path / "full")
+
+
+@pytest.mark.parametrize("layout", LAYOUTS)
+def test_shards_match_serial_run(fixture, tmp_path, monkeypatch, layout):
+    nids = pdf_nids(fixture)
+    # The colliding ETDs land in different shards.
+    share_pdf_name(fixture, [nids[4], nids[5], nids[6]])
+    fid, _, _ = pdf(fixture, nids[8])
+    with snapshot(fixture) as db:
+        db.execute(
+            "UPDATE `filehash` SET `md5` = ? WHERE `fid` = ?",
+            ("0" * 32, fid),
+        )
+        db.execute(
+            "INSERT INTO `field_data_dcterms_creator` VALUES (?, 1, ?)",
+            (nids[9], "Second, Creator"),
+        )
+    # Failed ETDs make the exit status 1.
+    args = ("--layout", layout, "--collect-errors")
+    assert run(fixture, tmp_path / "serial", monkeypatch, *args) == 1
+    assert (
+        run(fixture, tmp_path / "sharded", monkeypatch, *args, "--shards", "3")
+        == 1
+    )
+    serial = outputs(tmp_path / "serial")
+    assert outputs(tmp_path / "sharded") == serial
+    errors = serial["texts"]["extract-errors.csv"]
+    assert "has the wrong hash." in errors
+    assert "does not have exactly one creator." in errors
+    if layout == "flat":
+        assert errors.count("already copied.") == 2
+    if layout == "hash":
+        assert sum("shared" in name for name in serial["files"]) == 3
@@ -0,0 +1,33 @@
+from subject_index import SubjectIndex, build_index, sorted_unique
+import pytest
+
+
+@pytest.fixture(scope="module")
+def common_tokens_index(tmp_path_factory):
+    # Every token of "Canada--History" is shared by more labels than the
+    # candidate limit.
+    labels = [f"Agriculture {n}--Canada" for n in range(25000)]
+    labels += [f"History {n}" for n in range(30000)]
+    labels += ["Canada--History", "Québec--History", "Label é 5"]
+    index_path = tmp_path_factory.mktemp("index") / "subjects.idx"
+    build_index(index_path, sorted_unique(labels), {})
+    with SubjectIndex(index_path) as index:
+        yield index
+
+
+@pytest.mark.parametrize(
+    "subject", ["Canada -- Histroy", "Canada -- Histry.", "Kanada -- History"]
+)
+def test_near_matches_with_common_tokens(common_tokens_index, subject):
+    assert common_tokens_index.near_matches(subject)[0] == "Canada--History"
+
+
+def test_near_matches_puts_exact_keys_first(common_tokens_index):
+    assert (
+        common_tokens_index.near_matches("Quebec -- History.")[0]
+        == "Québec--History"
+    )
+
+
+def test_near_matches_keeps_single_characters(common_tokens_index):
+    assert "Label é 5" in common_tokens_index.near_matches("Label e 5")
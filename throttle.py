@@ -0,0 +1,182 @@
+import json
+import os
+import threading
+import time
+
+SETTINGS = ("read_rate", "max_reads", "query_rate")
+
+# How often the control file is looked at, in seconds.
+CHECK_INTERVAL = 1.0
+
+# The longest a throttled thread sleeps before looking at the limits again.
+MAX_SLEEP = 0.1
+
+
+class TokenBucket:
+    """Hands out units at a steady rate, in bursts of up to a second's worth"""
+
+    def __init__(self, rate=None):
+        self._lock = threading.Lock()
+        self.rate = rate
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        if self.rate:
+            self._tokens = min(
+                self._tokens + (now - self._updated) * self.rate, self.rate
+            )
+        self._updated = now
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = rate
+            self._tokens = min(self._tokens, rate) if rate else 0.0
+
+    def take(self, n, check=None):
+        # Takers go into debt and sleep it off, so threads taking at the
+        # same time queue up behind each other. The debt is slept off in
+        # steps, calling check between them, so a new rate applies at once.
+        with self._lock:
+            if not self.rate:
+                return
+            self._refill(time.monotonic())
+            self._tokens -= n
+        while True:
+            with self._lock:
+                if not self.rate:
+                    return
+                self._refill(time.monotonic())
+                wait = -self._tokens / self.rate
+            if wait <= 0:
+                return
+            time.sleep(min(wait, MAX_SLEEP))
+            if check is not None:
+                check()
+
+
+class ConcurrencyLimit:
+    """A semaphore whose size can change while it is held"""
+
+    def __init__(self, limit=None):
+        self._condition = threading.Condition()
+        self.limit = limit
+        self.active = 0
+
+    def set_limit(self, limit):
+        with self._condition:
+            self.limit = limit
+            self._condition.notify_all()
+
+    def __enter__(self):
+        with self._condition:
+            while self.limit and self.active >= self.limit:
+                self._condition.wait()
+            self.active += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+class Throttle:
+    """Paces source file reads and database queries"""
+
+    def __init__(
+        self,
+        read_rate=None,
+        max_reads=None,
+        query_rate=None,
+        control_path=None,
+        share=1,
+    ):
+        self.reads = TokenBucket()
+        self.readers = ConcurrencyLimit()
+        self.queries = TokenBucket()
+        self.defaults = {
+            "read_rate": read_rate,
+            "max_reads": max_reads,
+            "query_rate": query_rate,
+        }
+        self.control_path = control_path
+        self.share = share
+        self._lock = threading.Lock()
+        self._checked = time.monotonic()
+        self._control_mtime = None
+        self._reload = control_path is not None
+        self.configure(**self.defaults)
+
+    def configure(self, read_rate=None, max_reads=None, query_rate=None):
+        # The limits are for the whole run, so each shard takes its share.
+        # read_rate is in MB/s.
+        self.reads.set_rate(
+            read_rate * 1e6 / self.share if read_rate else None
+        )
+        self.readers.set_limit(
+            max(1, max_reads // self.share) if max_reads else None
+        )
+        self.queries.set_rate(query_rate / self.share if query_rate else None)
+
+    def request_reload(self):
+        # Only sets a flag, so it is safe in a signal handler.
+        self._reload = True
+
+    def _load_control(self, force):
+        try:
+            mtime = os.stat(self.control_path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._control_mtime and not force:
+            return
+        settings = dict(self.defaults)
+        if mtime is not None:
+            try:
+                with open(self.control_path, encoding="utf-8") as f:
+                    control = json.load(f)
+            except ValueError:
+                # Probably caught half written, so try again next time.
+                return
+            if not isinstance(control, dict) or not all(
+                value is None
+                or (isinstance(value, (int, float)) and value > 0)
+                for name, value in control.items()
+                if name in SETTINGS
+            ):
+                return
+            settings.update(
+                (name, control[name]) for name in SETTINGS if name in control
+            )
+        self._control_mtime = mtime
+        self.configure(**settings)
+
+    def check(self):
+        # Look for new limits in the control file once a second, or as soon
+        # as a reload was requested.
+        if self.control_path is None:
+            return
+        now = time.monotonic()
+        if not self._reload and now - self._checked < CHECK_INTERVAL:
+            return
+        with self._lock:
+            if not self._reload and now - self._checked < CHECK_INTERVAL:
+                return
+            force = self._reload
+            self._reload = False
+            self._checked = now
+            self._load_control(force)
+
+    def reading(self):
+        # Held while a source file is read.
+        self.check()
+        return self.readers
+
+    def read(self, n):
+        self.check()
+        self.reads.take(n, self.check)
+
+    def query(self):
+        self.check()
+        self.queries.take(1, self.check)